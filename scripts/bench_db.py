@@ -0,0 +1,121 @@
+"""
+measure the overhead of mailadm.db for typical requests.
+
+usage: python scripts/bench_db.py [ITERATIONS]
+
+1. per-request overhead of a web-request-like token lookup and a small write,
+   with connection pooling disabled (MAILADM_DB_POOLSIZE=0) and enabled.
+2. signups (reserve + confirm, while another thread keeps listing users) and
+   prune (claim + delete) with the "default" and "performance" sqlite profiles.
+
+The database is created in the current directory, so run it on the kind of
+disk mailadm runs on; tmpfs hides the cost of syncing to disk.
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import mailadm.conn
+import mailadm.db
+
+
+def make_db(basedir):
+    # without the "DB: Migrating tables ..." messages
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = mailadm.db.DB(Path(basedir).joinpath("mailadm.db"))
+        db.init_config("example.org", "https://example.org/new_email",
+                       "https://mailcow.example.org/api/v1/", "token")
+    with db.write_transaction() as conn:
+        conn.add_token("bench", token="1d_benchmark", expiry="1d", prefix="tmp.",
+                       maxuse=10 ** 9)
+    return db
+
+
+def read_request(db):
+    with db.read_connection() as conn:
+        conn.get_tokeninfo_by_token("1d_benchmark")
+
+
+def write_request(db):
+    with db.write_transaction() as conn:
+        conn.execute("UPDATE tokens SET usecount = usecount WHERE name = ?", ("bench",))
+
+
+def bench(func, db, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(db)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def bench_signups(db, iterations):
+    with db.read_connection() as conn:
+        token_info = conn.get_tokeninfo_by_name("bench")
+    stop = threading.Event()
+    listings = []
+
+    def list_users():
+        while not stop.is_set():
+            with db.read_connection() as conn:
+                for user_info in conn.execute("SELECT addr FROM users"):
+                    pass
+            listings.append(1)
+
+    reader = threading.Thread(target=list_users)
+    reader.start()
+    start = time.perf_counter()
+    for i in range(iterations):
+        addr = "tmp.{}.{}@example.org".format(time.time(), i)
+        db.write(lambda conn: conn.reserve_email_account(token_info, addr=addr))
+        db.write(lambda conn: conn.confirm_email_account(addr, ttl=60))
+    duration = time.perf_counter() - start
+    stop.set()
+    reader.join()
+    return iterations / duration, len(listings) / duration
+
+
+def bench_prune(db, iterations):
+    with db.write_transaction() as conn:
+        for i in range(iterations):
+            conn.add_user_db("tmp.prune{}@example.org".format(i), 1000, 60, "bench")
+    start = time.perf_counter()
+    with db.write_transaction() as conn:
+        users = conn.claim_expired_users(int(time.time()))
+    for i in range(0, len(users), 100):
+        chunk = [user_info.addr for user_info in users[i:i + 100]]
+        db.write(lambda conn: conn.del_users_db(chunk))
+    return time.perf_counter() - start
+
+
+def main(iterations):
+    # "added addr ..." for every signup would swamp the results and be measured, too
+    mailadm.conn.Connection.log = lambda self, msg: None
+    with tempfile.TemporaryDirectory(dir=os.getcwd()) as basedir:
+        db = make_db(basedir)
+        for poolsize in ["0", "8"]:
+            os.environ["MAILADM_DB_POOLSIZE"] = poolsize
+            mailadm.db._reset_registry()
+            for func in (read_request, write_request):
+                usec = bench(func, db, iterations)
+                print("poolsize={} {:14s} {:8.1f} usec/request".format(
+                      poolsize, func.__name__, usec))
+
+    for profile in ["default", "performance"]:
+        os.environ["MAILADM_SQLITE_PROFILE"] = profile
+        mailadm.db._reset_registry()
+        with tempfile.TemporaryDirectory(dir=os.getcwd()) as basedir:
+            db = make_db(basedir)
+            signups, listings = bench_signups(db, iterations)
+            print("profile={:11s} signups {:8.1f} per second ({:.1f} user listings/s)".format(
+                  profile, signups, listings))
+            print("profile={:11s} prune   {:8.3f} seconds for {} users".format(
+                  profile, bench_prune(db, iterations), iterations))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
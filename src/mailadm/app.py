@@ -2,51 +2,66 @@
 help gunicorn and other WSGI servers to instantiate a web instance of mailadm
 """
 import sys
-import os
 
 from .web import create_app_from_db_path
 import time
-import threading
 from .db import get_db_path, DB
-from mailadm.commands import prune
+from mailadm.conn import get_mirror_maxage
+from mailadm.mailcow import MailcowError
+from mailadm.outbox import get_next_delay, process_outbox
+from mailadm.pool import fill_pool, get_pool_max
+from mailadm.scheduler import PruneScheduler
+from mailadm.supervisor import Service, Supervisor
+from requests.exceptions import RequestException
 from mailadm.bot import main as run_bot
 from mailadm.bot import get_admbot_db_path
 
 
-def prune_loop():
+def mirror_loop():
     db = DB(get_db_path())
     while 1:
-        for logmsg in prune(db).get("message"):
-            # the file=sys.stderr seems to be necessary so the output is shown in `docker logs`
-            print(logmsg, file=sys.stderr)
-        time.sleep(600)
-
-
-def watcher():
-    running = 2
-    while running == 2:
-        running = 0
-        threads = threading.enumerate()
-        if "prune" in [t.getName() for t in threads]:
-            running += 1
-        else:
-            print("prune thread died, killing everything now", file=sys.stderr)
-        if "bot" in [t.getName() for t in threads]:
-            running += 1
-        else:
-            print("bot thread died, killing everything now", file=sys.stderr)
-    else:
-        os._exit(1)
+        try:
+            db.refresh_mailbox_mirror()
+        except (MailcowError, RequestException) as e:
+            print("failed to refresh the mailbox mirror:", e, file=sys.stderr)
+        time.sleep(get_mirror_maxage() / 2)
+
+
+def pool_loop():
+    db = DB(get_db_path())
+    while 1:
+        try:
+            fill_pool(db)
+        except (MailcowError, RequestException) as e:
+            print("failed to fill the account pool:", e, file=sys.stderr)
+        time.sleep(30)
+
+
+def outbox_loop():
+    db = DB(get_db_path())
+    while 1:
+        process_outbox(db)
+        time.sleep(get_next_delay(db, maxdelay=60))
 
 
 def init_threads():
-    prunethread = threading.Thread(target=prune_loop, daemon=True, name="prune")
-    prunethread.start()
-    botthread = threading.Thread(target=run_bot, args=(DB(get_db_path()), get_admbot_db_path()),
-                                 daemon=True, name="bot")
-    botthread.start()
-    watcherthread = threading.Thread(target=watcher, daemon=True, name="watcher")
-    watcherthread.start()
+    db = DB(get_db_path())
+    with db.write_transaction() as conn:
+        conn.del_service_statuses()
+
+    def record_status(name, status):
+        db.write(lambda conn: conn.set_service_status(name, **status))
+
+    supervisor = Supervisor(on_status=record_status)
+    supervisor.add(Service("prune", PruneScheduler(db).run))
+    supervisor.add(Service("outbox", outbox_loop))
+    supervisor.add(Service("bot", run_bot, args=(db, get_admbot_db_path())))
+    if get_mirror_maxage() > 0:
+        supervisor.add(Service("mirror", mirror_loop))
+    if get_pool_max() > 0:
+        supervisor.add(Service("pool", pool_loop))
+    supervisor.start()
+    return supervisor
 
 
 app = create_app_from_db_path()
@@ -119,8 +119,8 @@ class AdmBot:
         elif arguments[0] == "/list-users":
             token = arguments[1] if len(arguments) > 1 else None
             with self.db.read_connection() as conn:
-                users = conn.get_user_list(token=token)
-            lines = ["%s [%s]" % (user.addr, user.token_name) for user in users]
+                lines = ["%s [%s]" % (user.addr, user.token_name)
+                         for user in conn.iter_user_list(token=token)]
             text = "\n".join(lines)
             self.reply(text, message)
 
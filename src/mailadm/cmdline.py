@@ -12,12 +12,14 @@ from .conn import UserInfo
 from .mailcow import MailcowError
 import mailadm.util
 import sys
+import time
 import click
 from click import style
 import qrcode
 
 import mailadm.db
 import mailadm.commands
+import mailadm.outbox
 import mailadm.util
 from .conn import DBError
 from .bot import SetupPlugin, get_admbot_db_path
@@ -187,6 +189,13 @@ def config(ctx):
         click.secho("** mailadm database path: {}".format(db.path))
         for name, val in conn.get_config_items():
             click.secho("{:22s} {}".format(name, val))
+    click.secho("** sqlite settings:")
+    for pragma, expected, actual in db.check_sqlite_profile():
+        if actual == expected:
+            click.secho("{:22s} {}".format(pragma, actual))
+        else:
+            click.secho("{:22s} {} (WARNING: expected {})".format(pragma, actual, expected),
+                        fg="red")
 
 
 @click.command()
@@ -204,7 +213,7 @@ def list_users(ctx, token):
     """list users """
     db = get_mailadm_db(ctx)
     with db.read_connection() as conn:
-        for user_info in conn.get_user_list(token=token):
+        for user_info in conn.iter_user_list(token=token):
             click.secho("{} [{}]".format(user_info.addr, user_info.token_name))
 
 
@@ -214,6 +223,8 @@ def dump_token_info(token_info):
     click.echo("  expiry = {}".format(token_info.expiry))
     click.echo("  maxuse = {}".format(token_info.maxuse))
     click.echo("  usecount = {}".format(token_info.usecount))
+    if token_info.rate is not None:
+        click.echo("  rate   = {} signups per minute".format(token_info.rate))
     click.echo("  token  = {}".format(token_info.token))
     click.echo("  " + token_info.get_web_url())
     click.echo("  " + token_info.get_qr_uri())
@@ -228,12 +239,14 @@ def dump_token_info(token_info):
 @click.option("--prefix", type=str, default="tmp.",
               help="prefix for all e-mail addresses for this token")
 @click.option("--token", type=str, default=None, help="name of token to be used")
+@click.option("--rate", type=float, default=None,
+              help="signups per minute, 0 for no limit -- default is MAILADM_TOKEN_RATE")
 @click.pass_context
-def add_token(ctx, name, expiry, maxuse, prefix, token):
+def add_token(ctx, name, expiry, maxuse, prefix, token, rate):
     """add new token for generating new e-mail addresses
     """
     db = get_mailadm_db(ctx)
-    result = mailadm.commands.add_token(db, name, expiry, maxuse, prefix, token)
+    result = mailadm.commands.add_token(db, name, expiry, maxuse, prefix, token, rate=rate)
     if result["status"] == "error":
         ctx.fail(result["message"])
     click.secho(result["message"])
@@ -247,14 +260,16 @@ def add_token(ctx, name, expiry, maxuse, prefix, token):
               help="maximum number of accounts this token can create, default is not to change")
 @click.option("--prefix", type=str, default=None,
               help="prefix for all e-mail addresses for this token, default is not to change")
+@click.option("--rate", type=float, default=None,
+              help="signups per minute, 0 for no limit, default is not to change")
 @click.pass_context
-def mod_token(ctx, name, expiry, prefix, maxuse):
+def mod_token(ctx, name, expiry, prefix, maxuse, rate):
     """modify a token selectively
     """
     db = get_mailadm_db(ctx)
 
     with db.write_transaction() as conn:
-        conn.mod_token(name=name, expiry=expiry, maxuse=maxuse, prefix=prefix)
+        conn.mod_token(name=name, expiry=expiry, maxuse=maxuse, prefix=prefix, rate=rate)
         tc = conn.get_tokeninfo_by_name(name)
         dump_token_info(tc)
 
@@ -339,19 +354,31 @@ def add_user(ctx, addr, password, token, dryrun):
 @click.pass_context
 def del_user(ctx, addr):
     """remove e-mail address"""
-    with get_mailadm_db(ctx).write_transaction() as conn:
+    db = get_mailadm_db(ctx)
+    with db.write_transaction() as conn:
         try:
             conn.delete_email_account(addr)
-        except (DBError, MailcowError) as e:
+        except DBError as e:
             ctx.fail("failed to delete e-mail account {}: {}".format(addr, e))
+    failed = mailadm.outbox.process_outbox(db, addrs=[addr])
+    if failed:
+        click.secho("failed to delete mailbox {} in mailcow, will retry: {}".format(
+                    addr, failed[addr]), fg="red")
 
 
 @click.command()
 @option_dryrun
+@click.option("--chunk-size", type=int, default=100, show_default=True,
+              help="number of accounts to delete with one mailcow API call")
+@click.option("--max", "max_", type=int, default=None,
+              help="delete at most this many accounts, the ones which expired first")
+@click.option("--rate", type=float, default=None,
+              help="delete at most this many accounts per second")
 @click.pass_context
-def prune(ctx, dryrun):
+def prune(ctx, dryrun, chunk_size, max_, rate):
     """prune expired users from postfix and dovecot configurations """
-    result = mailadm.commands.prune(get_mailadm_db(ctx), dryrun=dryrun)
+    result = mailadm.commands.prune(get_mailadm_db(ctx), dryrun=dryrun, chunksize=chunk_size,
+                                    limit=max_, rate=rate)
     for msg in result.get("message"):
         if result.get("status") == "error":
             ctx.fail(msg)
@@ -359,6 +386,30 @@ def prune(ctx, dryrun):
             click.secho(msg)
 
 
+@click.command()
+@click.option("--retry", is_flag=True, default=False,
+              help="retry all entries now, including the ones which were given up")
+@click.pass_context
+def outbox(ctx, retry):
+    """show pending outbox entries: mailboxes which are still to be deleted ("delete"),
+    and unfinished signups whose mailboxes are still to be cleaned up ("create").
+    --retry revives the entries which were given up and retries all of them now.
+    """
+    db = get_mailadm_db(ctx)
+    if retry:
+        with db.write_transaction() as conn:
+            num = conn.revive_outbox()
+        failed = mailadm.outbox.process_outbox(db, limit=num)
+        click.secho("retried {} entries, {} failed".format(num, len(failed)))
+    with db.read_connection() as conn:
+        for entry in conn.get_outbox():
+            click.secho("{} {} [attempts: {}, {}{}]".format(
+                entry.action, entry.addr, entry.attempts,
+                "given up" if entry.dead else "next: " + time.ctime(entry.next_attempt),
+                ", error: " + entry.error if entry.error else ""),
+                fg="red" if entry.dead else None)
+
+
 @click.command()
 @click.pass_context
 @click.option("--debug", is_flag=True, default=False,
@@ -381,6 +432,12 @@ def migrate_db(ctx):
 
         q = "SELECT addr, date, ttl, token_name from users"
         users = [UserInfo(*args) for args in conn.execute(q).fetchall()]
+        # columns of later migrations, e.g. of pending signups, are restored after they ran
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+        kept = [name for name in ("pending", "prune_claim", "expires_at") if name in columns]
+        if kept:
+            q = "SELECT {}, addr FROM users".format(", ".join(kept))
+            kept_values = conn.execute(q).fetchall()
         q = "DROP TABLE users"
         conn.execute(q)
 
@@ -401,6 +458,16 @@ def migrate_db(ctx):
         q = "DELETE FROM config WHERE name=?"
         conn.execute(q, ("vmail_user",))
         conn.execute(q, ("path_virtual_mailboxes",))
+        conn.bump_generation("config")
+
+        # the users table was recreated with the initial schema, apply later migrations again
+        conn.set_config("dbversion", 1)
+        db.upgrade_tables(conn)
+        if kept:
+            q = "UPDATE users SET {} WHERE addr = ?".format(
+                ", ".join(name + " = ?" for name in kept))
+            for values in kept_values:
+                conn.execute(q, values)
 
 
 mailadm_main.add_command(setup_bot)
@@ -415,6 +482,7 @@ mailadm_main.add_command(add_user)
 mailadm_main.add_command(del_user)
 mailadm_main.add_command(list_users)
 mailadm_main.add_command(prune)
+mailadm_main.add_command(outbox)
 mailadm_main.add_command(web)
 mailadm_main.add_command(migrate_db)
 
@@ -1,11 +1,13 @@
 import time
+import mailadm.metrics
 from mailadm.util import get_human_readable_id
 from mailadm.conn import DBError
 from mailadm.mailcow import MailcowError
 from mailadm.gen_qr import gen_qr
+from mailadm.outbox import process_outbox
 
 
-def add_token(db, name, expiry, maxuse, prefix, token) -> dict:
+def add_token(db, name, expiry, maxuse, prefix, token, rate=None) -> dict:
     """Adds a token to create users
     """
     if token is None:
@@ -13,7 +15,7 @@ def add_token(db, name, expiry, maxuse, prefix, token) -> dict:
     with db.write_transaction() as conn:
         try:
             info = conn.add_token(name=name, token=token, expiry=expiry, maxuse=maxuse,
-                                  prefix=prefix)
+                                  prefix=prefix, rate=rate)
         except DBError:
             return {"status": "error", "message": "token %s does already exist" % (name,)}
         except ValueError:
@@ -25,7 +27,7 @@ def add_token(db, name, expiry, maxuse, prefix, token) -> dict:
 def add_user(db, token=None, addr=None, password=None, dryrun=False) -> {}:
     """Adds a new user to be managed by mailadm
     """
-    with db.write_transaction() as conn:
+    with db.read_connection() as conn:
         if token is None:
             if "@" not in addr:
                 # there is probably a more pythonic solution to this.
@@ -42,49 +44,83 @@ def add_user(db, token=None, addr=None, password=None, dryrun=False) -> {}:
             if token_info is None:
                 return {"status": "error",
                         "message": "token does not exist: {!r}".format(token)}
-        try:
-            user_info = conn.add_email_account(token_info, addr=addr, password=password)
-        except DBError as e:
-            return {"status": "error",
-                    "message": "failed to add e-mail account {}: {}".format(addr, e)}
-        except MailcowError as e:
-            return {"status": "error",
-                    "message": "failed to add e-mail account {}: {}".format(addr, e)}
-        if dryrun:
+    try:
+        user_info = db.add_email_account_tries(token_info, addr=addr, password=password)
+    except DBError as e:
+        return {"status": "error",
+                "message": "failed to add e-mail account {}: {}".format(addr, e)}
+    except MailcowError as e:
+        return {"status": "error",
+                "message": "failed to add e-mail account {}: {}".format(addr, e)}
+    if dryrun:
+        with db.write_transaction() as conn:
             conn.delete_email_account(user_info.addr)
-            return {"status": "dryrun",
-                    "message": user_info}
-        return {"status": "success",
+        process_outbox(db, addrs=[user_info.addr])
+        return {"status": "dryrun",
                 "message": user_info}
+    return {"status": "success",
+            "message": user_info}
+
 
+def prune(db, dryrun=False, chunksize=100, limit=None, rate=None) -> {}:
+    """Delete expired users from mailcow and mailadm.
 
-def prune(db, dryrun=False) -> {}:
+    With limit, at most that many users are deleted, the ones which expired first. With
+    rate, at most that many users are deleted per second, in correspondingly small chunks.
+
+    The database is only locked for short moments: first the expired users are claimed,
+    then each chunk of them is removed from the database and their mailboxes are recorded
+    in the outbox for deletion, which is then carried out in mailcow. If prune crashes
+    after claiming, the claims expire and a later prune run finishes the job; deletions
+    which fail are retried by the outbox worker.
+    """
     sysdate = int(time.time())
-    with db.write_transaction() as conn:
-        expired_users = conn.get_expired_users(sysdate)
-        if not expired_users:
-            return {"status": "success",
-                    "message": ["nothing to prune"]}
-        if dryrun:
-            result = {"status": "dryrun",
-                      "message": []}
-            for user_info in expired_users:
-                result["message"].append("would delete %s (token %s)" %
-                                         (user_info.addr, user_info.token_name))
-        else:
-            result = {"status": "success",
-                      "message": []}
-            for user_info in expired_users:
-                try:
-                    conn.delete_email_account(user_info.addr)
-                except (DBError, MailcowError) as e:
-                    result["status"] = "error"
-                    result["message"].append("failed to delete account %s: %s" %
-                                             (user_info.addr, e))
-                    continue
+    if dryrun:
+        with db.read_connection() as conn:
+            expired_users = conn.get_expired_users(sysdate, limit=limit)
+    else:
+        with db.write_transaction() as conn:
+            expired_users = conn.claim_expired_users(sysdate, limit=limit)
+    if not expired_users:
+        return {"status": "success",
+                "message": ["nothing to prune"]}
+    if dryrun:
+        result = {"status": "dryrun",
+                  "message": []}
+        for user_info in expired_users:
+            result["message"].append("would delete %s (token %s)" %
+                                     (user_info.addr, user_info.token_name))
+        return result
+
+    if rate:
+        chunksize = max(1, min(chunksize, int(rate)))
+    result = {"status": "success",
+              "message": []}
+    start = time.monotonic()
+    for i in range(0, len(expired_users), chunksize):
+        if rate:
+            # spread the deletions, so mailcow isn't hit with all of them at once
+            time.sleep(max(0, start + i / rate - time.monotonic()))
+        chunk = expired_users[i:i + chunksize]
+        addrs = [user_info.addr for user_info in chunk]
+
+        def move_to_outbox(conn):
+            conn.del_users_db(addrs)
+            for addr in addrs:
+                conn.add_outbox("delete", addr)
+        with mailadm.metrics.prune_batch_seconds.time():
+            db.write(move_to_outbox)
+            failed = process_outbox(db, addrs=addrs)
+        mailadm.metrics.prune_batch_size.observe(len(addrs))
+        for user_info in chunk:
+            if user_info.addr in failed:
+                result["status"] = "error"
+                result["message"].append("failed to delete account %s, will retry: %s" %
+                                         (user_info.addr, failed[user_info.addr]))
+            else:
                 result["message"].append("pruned %s (token %s)" %
                                          (user_info.addr, user_info.token_name))
-        return result
+    return result
 
 
 def list_tokens(db) -> str:
@@ -1,7 +1,28 @@
+import os
+import sys
 import time
 import sqlite3
 import mailadm.util
-from .mailcow import MailcowConnection, MailcowError
+from .mailcow import MailcowConnection, MailcowError, MailcowUser
+
+
+# seconds after which prune removes a signup that was reserved but never confirmed
+PENDING_TTL = 10 * 60
+
+
+def get_expires_at(date, ttl):
+    # "never" expiring tokens have a ttl of sys.maxsize, which must not overflow
+    return min(date + ttl, sys.maxsize)
+
+
+def get_mirror_maxage():
+    """How many seconds the local mirror of mailcow mailboxes may be out of date; 0 disables it."""
+    return int(os.environ.get("MAILCOW_MIRROR_MAXAGE", 600))
+
+
+# process-wide caches of data derived from a mailadm.db, keyed by database path
+_prefix_indexes = {}
+_configs = {}
 
 
 class DBError(Exception):
@@ -17,16 +38,21 @@ class UserNotFound(DBError):
 
 
 class Connection:
-    def __init__(self, sqlconn, path, write):
+    def __init__(self, sqlconn, path, write, release=None):
         self._sqlconn = sqlconn
         self.path_mailadm_db = path
         self._write = write
+        self._release = release
 
     def log(self, msg):
         print(msg)
 
     def close(self):
-        self._sqlconn.close()
+        if self._release is not None:
+            self._release(self._sqlconn)
+            self._release = None
+        else:
+            self._sqlconn.close()
 
     def commit(self):
         self._sqlconn.commit()
@@ -58,6 +84,9 @@ class Connection:
 
     @property
     def config(self):
+        return self._get_cached(_configs, "config", self._build_config)
+
+    def _build_config(self):
         items = self.get_config_items()
         if items:
             d = dict(items)
@@ -90,6 +119,38 @@ class Connection:
         assert name in ok, name
         q = "INSERT OR REPLACE INTO config (name, value) VALUES (?, ?)"
         self.cursor().execute(q, (name, value)).fetchone()
+        self.bump_generation("config")
+        return value
+
+    def get_meta(self, name):
+        q = "SELECT value FROM meta WHERE name = ?"
+        res = self._sqlconn.execute(q, (name,)).fetchone()
+        return res[0] if res is not None else 0
+
+    def set_meta(self, name, value):
+        q = "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)"
+        self._sqlconn.execute(q, (name, value))
+
+    def bump_generation(self, name):
+        """Increase a generation counter, so caches of other processes get invalidated."""
+        q = "INSERT OR IGNORE INTO meta (name, value) VALUES (?, 0)"
+        self._sqlconn.execute(q, (name + "_generation",))
+        q = "UPDATE meta SET value = value + 1 WHERE name = ?"
+        self._sqlconn.execute(q, (name + "_generation",))
+
+    def get_generation(self, name):
+        return self.get_meta(name + "_generation")
+
+    def _get_cached(self, cache, generation_name, build):
+        # write connections can see uncommitted generations, so they don't fill the cache
+        generation = self.get_generation(generation_name)
+        key = str(self.path_mailadm_db)
+        cached = cache.get(key)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        value = build()
+        if not self._write:
+            cache[key] = (generation, value)
         return value
 
     #
@@ -100,19 +161,30 @@ class Connection:
         q = "SELECT name from tokens"
         return [x[0] for x in self.execute(q).fetchall()]
 
-    def add_token(self, name, token, expiry, prefix, maxuse=50):
-        q = "INSERT INTO tokens (name, token, prefix, expiry, maxuse) VALUES (?, ?, ?, ?, ?)"
-        self.execute(q, (name, token, prefix, expiry, int(maxuse)))
+    def get_token_usage(self):
+        """Return (name, usecount, maxuse) tuples of all tokens, ordered by name."""
+        q = "SELECT name, usecount, maxuse FROM tokens ORDER BY name"
+        return [tuple(row) for row in self.execute(q).fetchall()]
+
+    def add_token(self, name, token, expiry, prefix, maxuse=50, rate=None):
+        q = """INSERT INTO tokens (name, token, prefix, expiry, maxuse, rate)
+               VALUES (?, ?, ?, ?, ?, ?)"""
+        self.execute(q, (name, token, prefix, expiry, int(maxuse),
+                         None if rate is None else float(rate)))
+        self.bump_generation("tokens")
         self.log("added token {!r}".format(name))
         return self.get_tokeninfo_by_name(name)
 
-    def mod_token(self, name, expiry=None, prefix=None, maxuse=None):
+    def mod_token(self, name, expiry=None, prefix=None, maxuse=None, rate=None):
         token_info = self.get_tokeninfo_by_name(name)
         expiry = expiry if expiry is not None else token_info.expiry
         maxuse = maxuse if maxuse is not None else token_info.maxuse
         prefix = prefix if prefix is not None else token_info.prefix
-        q = "REPLACE INTO tokens (name, token, prefix, expiry, maxuse) VALUES (?, ?, ?, ?, ?)"
-        self.execute(q, (name, token_info.token, prefix, expiry, maxuse))
+        rate = float(rate) if rate is not None else token_info.rate
+        # an UPDATE, unlike REPLACE, keeps the usecount
+        q = "UPDATE tokens SET prefix = ?, expiry = ?, maxuse = ?, rate = ? WHERE name = ?"
+        self.execute(q, (prefix, expiry, maxuse, rate, name))
+        self.bump_generation("tokens")
         self.log("modified token {!r}".format(name))
         return self.get_tokeninfo_by_name(name)
 
@@ -122,6 +194,7 @@ class Connection:
         c.execute(q, (name, ))
         if c.rowcount == 0:
             raise ValueError("token {!r} does not exist".format(name))
+        self.bump_generation("tokens")
         self.log("deleted token {!r}".format(name))
 
     def get_tokeninfo_by_name(self, name):
@@ -140,78 +213,119 @@ class Connection:
         if not addr.endswith(self.config.mail_domain):
             raise ValueError("addr {!r} does not use mail domain {!r}".format(
                              addr, self.config.mail_domain))
-        q = TokenInfo._select_token_columns
-        for res in self.execute(q).fetchall():
-            token_info = TokenInfo(self.config, *res)
-            if addr.startswith(token_info.prefix):
-                return token_info
+        name = self._get_cached(_prefix_indexes, "tokens", self._build_prefix_index) \
+            .longest_prefix_value(addr)
+        if name is not None:
+            return self.get_tokeninfo_by_name(name)
+
+    def _build_prefix_index(self):
+        index = mailadm.util.PrefixTrie()
+        for name, prefix in self.execute("SELECT name, prefix FROM tokens ORDER BY name"):
+            index.add(prefix or "", name)
+        return index
 
     #
     # user management
     #
 
-    def add_email_account_tries(self, token_info, addr=None, password=None, tries=1):
-        """Try to add an email account."""
-        for i in range(tries):
-            try:
-                return self.add_email_account(token_info, addr=addr, password=password)
-            except (MailcowError, DBError):
-                if i + 1 >= tries:
-                    raise
-
-    def add_email_account(self, token_info, addr=None, password=None):
-        """Add an email account to the mailcow server & mailadm
-
-        :param token_info: the token which authorizes the new user creation
-        :param addr: email address for the new account; randomly generated if omitted
-        :param password: password for the new account; randomly generated if omitted
-        :return: a UserInfo object with the database information about the new user, plus password
-        """
-        token_info.check_exhausted()
-        if password is None:
-            password = mailadm.util.gen_password()
+    def make_addr(self, token_info, addr=None):
+        """Check an address for a new account, or generate a random one for the token."""
         if addr is None:
             rand_part = mailadm.util.get_human_readable_id()
             username = "{}{}".format(token_info.prefix, rand_part)
             addr = "{}@{}".format(username, self.config.mail_domain)
-        else:
-            if not addr.endswith(self.config.mail_domain):
-                raise ValueError("email {!r} is not on domain {!r}".format(
-                    addr, self.config.mail_domain))
-
-        # first check that mailcow doesn't have a user with that name already:
-        if self.get_mailcow_connection().get_user(addr):
-            raise MailcowError("account does already exist")
-
-        self.add_user_db(addr=addr, date=int(time.time()),
-                         ttl=token_info.get_expiry_seconds(), token_name=token_info.name)
+        elif not addr.endswith(self.config.mail_domain):
+            raise ValueError("email {!r} is not on domain {!r}".format(
+                addr, self.config.mail_domain))
+        return addr
 
-        self.log("added addr {!r} with token {!r}".format(addr, token_info.name))
+    def reserve_email_account(self, token_info, addr=None, ttl=PENDING_TTL, check_mailbox=True):
+        """Reserve a token use and an address for a new email account.
 
-        user_info = self.get_user_by_addr(addr)
-        user_info.password = password
+        The user is added as pending until confirm_email_account() is called. Prune leaves
+        pending users alone; if the signup never finishes, the "create" entry which the
+        caller records in the outbox releases the reservation.
 
-        # seems that everything is fine so far, so let's invoke mailcow:
-        self.get_mailcow_connection().add_user_mailcow(addr, password, token_info.name)
-
-        return user_info
+        :param token_info: the token which authorizes the new user creation
+        :param addr: email address for the new account; randomly generated if omitted
+        :param ttl: after how many seconds an unconfirmed reservation expires
+        :param check_mailbox: whether to check the mailbox mirror for an existing mailbox
+        :return: a UserInfo object of the pending user
+        """
+        addr = self.make_addr(token_info, addr)
+        if check_mailbox and self.mailbox_in_mirror(addr):
+            raise MailcowError("account does already exist")
+        # a confirmed user has a mailbox in mailcow, even if the mirror is stale
+        q = "SELECT 1 FROM users WHERE addr = ? AND pending = 0"
+        if check_mailbox and self.execute(q, (addr,)).fetchone() is not None:
+            raise MailcowError("account does already exist")
+        self.add_user_db(addr=addr, date=int(time.time()), ttl=ttl,
+                         token_name=token_info.name, pending=True)
+        return self.get_user_by_addr(addr)
+
+    def confirm_email_account(self, addr, ttl):
+        """Turn a pending user into a regular one which expires after ttl seconds."""
+        date = int(time.time())
+        q = """UPDATE users SET pending = 0, date = ?, ttl = ?, expires_at = ?
+               WHERE addr = ? AND pending = 1"""
+        if self.execute(q, (date, ttl, get_expires_at(date, ttl), addr)).rowcount == 0:
+            raise UserNotFound("pending addr {!r} does not exist".format(addr))
+        self.log("added addr {!r}".format(addr))
+        return self.get_user_by_addr(addr)
+
+    def release_email_account(self, addr):
+        """Remove a pending user and give its token use back; do nothing if there is none."""
+        q = "SELECT token_name FROM users WHERE addr = ? AND pending = 1"
+        row = self.execute(q, (addr,)).fetchone()
+        if row is not None:
+            self.execute("DELETE FROM users WHERE addr = ?", (addr,))
+            self.release_token_use(row[0])
 
     def delete_email_account(self, addr):
-        """Delete an email account from the mailcow server & mailadm.
+        """Delete an email account from mailadm and record its deletion in mailcow.
+
+        The mailbox is deleted from mailcow by mailadm.outbox.process_outbox() after the
+        transaction was committed.
 
         :param addr: the email address of the account which is to be deleted.
         """
-        self.get_mailcow_connection().del_user_mailcow(addr)
         self.del_user_db(addr)
+        self.add_outbox("delete", addr)
 
-    def add_user_db(self, addr, date, ttl, token_name):
-        self.execute("PRAGMA foreign_keys=on;")
+    def add_user_db(self, addr, date, ttl, token_name, pending=False):
+        self.reserve_token_use(token_name)
+        q = """INSERT INTO users (addr, date, ttl, token_name, pending, expires_at)
+               VALUES (?, ?, ?, ?, ?, ?)"""
+        try:
+            self.execute(q, (addr, date, ttl, token_name, int(pending),
+                             get_expires_at(date, ttl)))
+        except DBError:
+            # e.g. the address is taken; the transaction might go on with another one
+            self.release_token_use(token_name)
+            raise
+
+    def reserve_token_use(self, token_name):
+        """Count one more use of a token, unless it is exhausted.
+
+        This is a single conditional UPDATE, so concurrent signups can't overuse a token
+        even if their TokenInfo objects are outdated.
+        """
+        q = "UPDATE tokens SET usecount = usecount + 1 WHERE name = ? AND usecount < maxuse"
+        if self.execute(q, (token_name,)).rowcount == 0:
+            if self.get_tokeninfo_by_name(token_name) is None:
+                raise DBError("token does not exist")
+            raise TokenExhausted
 
-        q = """INSERT INTO users (addr, date, ttl, token_name)
-               VALUES (?, ?, ?, ?)"""
-        self.execute(q, (addr, date, ttl, token_name))
-        self.execute("UPDATE tokens SET usecount = usecount + 1"
-                     "  WHERE name=?", (token_name,))
+    def release_token_use(self, token_name):
+        """Give back a token use, e.g. after the mailbox couldn't be created."""
+        q = """UPDATE tokens SET usecount = usecount - 1
+               WHERE name = ? AND usecount > 0 AND usecount >= maxuse"""
+        if self.execute(q, (token_name,)).rowcount:
+            # the web workers might have cached the token as exhausted
+            self.bump_generation("tokens")
+        else:
+            q = "UPDATE tokens SET usecount = usecount - 1 WHERE name = ? AND usecount > 0"
+            self.execute(q, (token_name,))
 
     def del_user_db(self, addr):
         q = "DELETE FROM users WHERE addr=?"
@@ -220,46 +334,298 @@ class Connection:
             raise UserNotFound("addr {!r} does not exist".format(addr))
         self.log("deleted user {!r}".format(addr))
 
+    def del_users_db(self, addrs):
+        if not addrs:
+            return 0
+        q = "DELETE FROM users WHERE addr IN ({})".format(", ".join("?" * len(addrs)))
+        c = self.execute(q, addrs)
+        self.log("deleted {} users".format(c.rowcount))
+        return c.rowcount
+
+    def claim_expired_users(self, sysdate, claim_timeout=3600, limit=None):
+        """Mark expired users as being pruned, so no other prune run deletes them too.
+
+        Claims which are older than claim_timeout seconds are taken over, they were left
+        behind by a prune run which didn't finish. Pending users are left to their "create"
+        entries in the outbox, which give their token use back and only delete mailboxes
+        which the signup created.
+
+        :param sysdate: the current time as a unix timestamp
+        :param claim_timeout: after how many seconds a claim is considered stale
+        :param limit: claim at most this many users, the ones which expired first
+        :return: a list of UserInfo objects of the claimed users
+        """
+        q = UserInfo._select_user_columns + \
+            "WHERE expires_at < ? AND pending = 0\n" + \
+            "AND (prune_claim IS NULL OR prune_claim < ?) ORDER BY expires_at LIMIT ?"
+        args = (sysdate, sysdate - claim_timeout, -1 if limit is None else limit)
+        users = [UserInfo(*args) for args in self._sqlconn.execute(q, args).fetchall()]
+        self._sqlconn.executemany("UPDATE users SET prune_claim = ? WHERE addr = ?",
+                                  [(sysdate, user.addr) for user in users])
+        return users
+
+    def get_next_expiry(self, sysdate, claim_timeout=3600):
+        """Return when the next user can be claimed by claim_expired_users(), or None.
+
+        The result can be in the past if expired users are waiting to be pruned.
+        """
+        q = """SELECT expires_at FROM users WHERE prune_claim IS NULL AND pending = 0
+               ORDER BY expires_at LIMIT 1"""
+        row = self._sqlconn.execute(q).fetchone()
+        candidates = [row[0]] if row else []
+        # only users which already expired can be claimed, so this doesn't scan the table
+        q = """SELECT MIN(prune_claim) FROM users
+               WHERE expires_at < ? AND pending = 0 AND prune_claim IS NOT NULL"""
+        claim = self._sqlconn.execute(q, (sysdate,)).fetchone()[0]
+        if claim is not None:
+            candidates.append(claim + claim_timeout)
+        return min(candidates) if candidates else None
+
+    def get_min_token_ttl(self):
+        """Return the shortest lifetime of users created by any token, or None."""
+        q = "SELECT DISTINCT expiry FROM tokens"
+        ttls = [mailadm.util.parse_expiry_code(row[0]) for row in self.execute(q).fetchall()]
+        return min(ttls) if ttls else None
+
     def get_user_by_addr(self, addr):
         q = UserInfo._select_user_columns + "WHERE addr = ?"
         args = self._sqlconn.execute(q, (addr, )).fetchone()
         return UserInfo(*args)
 
-    def get_expired_users(self, sysdate):
-        q = UserInfo._select_user_columns + "WHERE (date + ttl) < ?"
+    def get_expired_users(self, sysdate, limit=None):
+        q = UserInfo._select_user_columns + \
+            "WHERE expires_at < ? AND pending = 0 ORDER BY expires_at LIMIT ?"
         users = []
-        for args in self._sqlconn.execute(q, (sysdate, )).fetchall():
+        args = (sysdate, -1 if limit is None else limit)
+        for args in self._sqlconn.execute(q, args).fetchall():
             users.append(UserInfo(*args))
         return users
 
     def get_user_list(self, token=None):
+        return list(self.iter_user_list(token=token))
+
+    def iter_user_list(self, token=None):
+        """Yield the mailadm users, reconciled with the mailboxes which exist in mailcow.
+
+        Users missing in mailcow are marked with a warning. Without a token filter, mailcow
+        mailboxes which are unknown to mailadm are yielded at the end.
+
+        :param token: only yield the users which were created with this token
+        """
         q = UserInfo._select_user_columns
         args = []
         if token is not None:
             q += "WHERE token_name=?"
             args.append(token)
-        dbusers = [UserInfo(*args) for args in self._sqlconn.execute(q, args).fetchall()]
         try:
-            mcusers = self.get_mailcow_connection().get_user_list()
-            if not token:
-                for mcuser in mcusers:
-                    if mcuser.addr not in [dbuser.addr for dbuser in dbusers]:
-                        dbusers.append(UserInfo(mcuser.addr, 0, 0, "created in mailcow"))
-            for dbuser in dbusers:
-                if dbuser.addr not in [mcuser.addr for mcuser in mcusers]:
-                    dbuser.token_name = "WARNING: does not exist in mailcow"
+            mcaddrs = dict.fromkeys(mcuser.addr for mcuser in self.get_mailcow_users())
         except MailcowError as e:
             self.log("Can't check mailcow users: " + str(e))
-        return dbusers
+            mcaddrs = None
+        for args in self._sqlconn.execute(q, args):
+            user_info = UserInfo(*args)
+            if mcaddrs is not None:
+                try:
+                    del mcaddrs[user_info.addr]
+                except KeyError:
+                    user_info.token_name = "WARNING: does not exist in mailcow"
+            yield user_info
+        if mcaddrs and not token:
+            for addr in self.get_pool_addrs():
+                mcaddrs.pop(addr, None)
+            for entry in self.get_outbox():
+                if entry.action == "delete" and mcaddrs.pop(entry.addr, False) is None:
+                    yield UserInfo(entry.addr, 0, 0, "WARNING: deletion failed" if entry.dead
+                                   else "being deleted")
+            for addr in mcaddrs:
+                yield UserInfo(addr, 0, 0, "created in mailcow")
 
-    def get_mailcow_connection(self) -> MailcowConnection:
-        return MailcowConnection(self.config.mailcow_endpoint, self.config.mailcow_token)
+    #
+    # local mirror of the mailcow mailboxes
+    #
+
+    def is_mailbox_mirror_fresh(self):
+        maxage = get_mirror_maxage()
+        return maxage > 0 and time.time() - self.get_meta("mailboxes_refreshed") <= maxage
+
+    def mailbox_in_mirror(self, addr):
+        """Check the local mirror for a mailcow mailbox; return None if the mirror is stale."""
+        if not self.is_mailbox_mirror_fresh():
+            return None
+        q = "SELECT 1 FROM mailboxes WHERE addr = ?"
+        return self._sqlconn.execute(q, (addr,)).fetchone() is not None
+
+    def get_mailcow_users(self):
+        """Return the mailcow mailboxes, from the local mirror unless it is stale."""
+        if self.is_mailbox_mirror_fresh():
+            q = "SELECT addr, token FROM mailboxes"
+            return [MailcowUser.from_mirror(*args) for args in self._sqlconn.execute(q)]
+        return self.get_mailcow_connection().get_user_list()
+
+    def set_mailbox_mirror(self, mcusers, refreshed):
+        """Replace the local mirror with a list of mailboxes which was fetched from mailcow.
+
+        Mirror entries which mailadm added after the list was fetched are kept.
+
+        :param mcusers: the MailcowUser objects of all mailboxes
+        :param refreshed: the unix timestamp when the list was fetched
+        """
+        self.execute("DELETE FROM mailboxes WHERE updated < ?", (refreshed,))
+        q = "INSERT OR IGNORE INTO mailboxes (addr, token, updated) VALUES (?, ?, ?)"
+        self._sqlconn.executemany(q, [(u.addr, u.token, refreshed) for u in mcusers])
+        self.set_meta("mailboxes_refreshed", refreshed)
+
+    def add_mailbox_mirror(self, addr, token_name):
+        q = "INSERT OR REPLACE INTO mailboxes (addr, token, updated) VALUES (?, ?, ?)"
+        self.execute(q, (addr, token_name, int(time.time())))
+
+    def del_mailboxes_mirror(self, addrs):
+        q = "DELETE FROM mailboxes WHERE addr = ?"
+        self._sqlconn.executemany(q, [(addr,) for addr in addrs])
+
+    #
+    # pool of inactive mailboxes which were created in advance
+    #
+
+    def add_pool_account(self, token_info, addr=None, ready=False):
+        """Add an account to the pool of a token.
+
+        Without addr, a random address is reserved; the account becomes ready for signups
+        with set_pool_account_ready() after its mailbox was created in mailcow. Its password
+        isn't stored, a new one is set when the mailbox is activated.
+
+        :return: the address of the pool account
+        """
+        if addr is None:
+            addr = self.make_addr(token_info)
+            q = "SELECT 1 FROM users WHERE addr = ?"
+            if self.mailbox_in_mirror(addr) or self.execute(q, (addr,)).fetchone():
+                raise DBError("addr {!r} is already taken".format(addr))
+        q = """INSERT INTO account_pool (addr, token_name, created, ready)
+               VALUES (?, ?, ?, ?)"""
+        self.execute(q, (addr, token_info.name, int(time.time()), int(ready)))
+        return addr
+
+    def set_pool_account_ready(self, addr):
+        self.execute("UPDATE account_pool SET ready = 1 WHERE addr = ?", (addr,))
+
+    def claim_pool_account(self, token_name):
+        """Take a ready account out of the pool of a token.
+
+        :return: the address, or None if the pool is empty
+        """
+        q = "SELECT addr FROM account_pool WHERE token_name = ? AND ready = 1 LIMIT 1"
+        res = self.execute(q, (token_name,)).fetchone()
+        if res is not None:
+            self.del_pool_accounts([res[0]])
+            return res[0]
+
+    def del_pool_accounts(self, addrs):
+        q = "DELETE FROM account_pool WHERE addr = ?"
+        self._sqlconn.executemany(q, [(addr,) for addr in addrs])
+
+    def get_pool_addrs(self, token_name=None):
+        q = "SELECT addr FROM account_pool"
+        args = ()
+        if token_name is not None:
+            q += " WHERE token_name = ?"
+            args = (token_name,)
+        return [x[0] for x in self.execute(q, args)]
+
+    def get_stale_pool_addrs(self, created_before):
+        """Return pool accounts whose token is gone, or which never became ready."""
+        q = """SELECT addr FROM account_pool LEFT JOIN tokens ON token_name = name
+               WHERE name IS NULL OR (ready = 0 AND created < ?)"""
+        return [x[0] for x in self.execute(q, (created_before,))]
+
+    def get_pool_target(self, token_info, since, minsize, maxsize):
+        """How many accounts the pool of a token should have.
+
+        The pool should cover as many signups as the token had since the given time, but
+        not more than the token can still create.
+        """
+        q = "SELECT COUNT(*) FROM users WHERE token_name = ? AND date > ?"
+        recent = self.execute(q, (token_info.name, since)).fetchone()[0]
+        available = token_info.maxuse - token_info.usecount
+        return max(0, min(max(recent, minsize), maxsize, available))
+
+    #
+    # status of the background services, see mailadm.supervisor
+    #
+
+    def set_service_status(self, name, state, restarts=0, error=None, since=None):
+        q = """INSERT OR REPLACE INTO services (name, state, restarts, error, since)
+               VALUES (?, ?, ?, ?, ?)"""
+        self.execute(q, (name, state, restarts, error, since))
+
+    def del_service_statuses(self):
+        self.execute("DELETE FROM services")
+
+    def get_service_statuses(self):
+        """Return a dict which maps service names to their status dicts."""
+        q = "SELECT name, state, restarts, error, since FROM services ORDER BY name"
+        return {name: dict(state=state, restarts=restarts, error=error, since=since)
+                for name, state, restarts, error, since in self.execute(q)}
+
+    #
+    # outbox of mailcow mailboxes which are to be created or deleted, see mailadm.outbox
+    #
+
+    def add_outbox(self, action, addr, token_name=None, delay=0):
+        """Record that a mailbox is to be created or deleted in mailcow.
+
+        An earlier entry for the same address is replaced.
+
+        :param action: "create" or "delete"
+        :param delay: after how many seconds the entry is due for the outbox worker
+        """
+        now = int(time.time())
+        q = """INSERT OR REPLACE INTO outbox (addr, action, token_name, created, next_attempt)
+               VALUES (?, ?, ?, ?, ?)"""
+        self.execute(q, (addr, action, token_name, now, now + delay))
+
+    def del_outbox(self, addrs):
+        self._sqlconn.executemany("DELETE FROM outbox WHERE addr = ?", [(addr,) for addr in addrs])
+
+    def retry_outbox(self, addr, error, next_attempt, dead=False):
+        q = """UPDATE outbox SET attempts = attempts + 1, error = ?, next_attempt = ?, dead = ?
+               WHERE addr = ?"""
+        self.execute(q, (str(error), next_attempt, int(dead), addr))
+
+    def revive_outbox(self):
+        """Make deletions and given up entries due now; return how many there are."""
+        q = """UPDATE outbox SET dead = 0, attempts = 0, next_attempt = ?
+               WHERE dead = 1 OR action = 'delete'"""
+        return self.execute(q, (int(time.time()),)).rowcount
+
+    def get_due_outbox(self, sysdate, limit=None):
+        """Return the entries which are due for the outbox worker, the most overdue first."""
+        q = OutboxEntry._select_outbox_columns + \
+            "WHERE dead = 0 AND next_attempt <= ? ORDER BY next_attempt LIMIT ?"
+        args = (sysdate, -1 if limit is None else limit)
+        return [OutboxEntry(*args) for args in self._sqlconn.execute(q, args).fetchall()]
+
+    def get_outbox(self, addrs=None):
+        q = OutboxEntry._select_outbox_columns
+        if addrs is None:
+            return [OutboxEntry(*args) for args in self.execute(q + "ORDER BY addr")]
+        q += "WHERE addr = ?"
+        return [OutboxEntry(*row) for addr in addrs for row in self.execute(q, (addr,))]
+
+    def get_next_outbox_attempt(self):
+        q = "SELECT MIN(next_attempt) FROM outbox WHERE dead = 0"
+        return self.execute(q).fetchone()[0]
+
+    def get_mailcow_connection(self, deadline=None) -> MailcowConnection:
+        return MailcowConnection(self.config.mailcow_endpoint, self.config.mailcow_token,
+                                 deadline=deadline)
 
 
 class TokenInfo:
-    _select_token_columns = "SELECT name, token, expiry, prefix, maxuse, usecount from tokens\n"
+    _select_token_columns = "SELECT name, token, expiry, prefix, maxuse, usecount, rate " \
+        "from tokens\n"
 
-    def __init__(self, config, name, token, expiry, prefix, maxuse, usecount):
+    def __init__(self, config, name, token, expiry, prefix, maxuse, usecount, rate=None):
         self.config = config
         self.name = name
         self.token = token
@@ -267,6 +633,8 @@ class TokenInfo:
         self.prefix = prefix
         self.maxuse = maxuse
         self.usecount = usecount
+        #: signups per minute, None for the MAILADM_TOKEN_RATE default
+        self.rate = rate
 
     def get_maxdays(self):
         return mailadm.util.parse_expiry_code(self.expiry) / (24 * 60 * 60)
@@ -281,10 +649,20 @@ class TokenInfo:
     def get_qr_uri(self):
         return "DCACCOUNT:" + self.get_web_url()
 
-    def check_exhausted(self):
-        """Check if a token can still create email accounts."""
-        if self.usecount >= self.maxuse:
-            raise TokenExhausted
+
+class OutboxEntry:
+    _select_outbox_columns = "SELECT addr, action, token_name, created, attempts, " \
+        "next_attempt, error, dead FROM outbox\n"
+
+    def __init__(self, addr, action, token_name, created, attempts, next_attempt, error, dead):
+        self.addr = addr
+        self.action = action
+        self.token_name = token_name
+        self.created = created
+        self.attempts = attempts
+        self.next_attempt = next_attempt
+        self.error = error
+        self.dead = bool(dead)
 
 
 class UserInfo:
@@ -1,71 +1,476 @@
-
 import os
+import sys
 import contextlib
+import itertools
+import queue
 import sqlite3
+import threading
 import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from pathlib import Path
 
-from .conn import Connection
+import mailadm.metrics
+import mailadm.tracing
+import mailadm.util
+from mailadm.util import DeadlineExceeded
+from .conn import Connection, DBError, UserNotFound, PENDING_TTL
+from .mailcow import MailcowError, get_circuit_breaker
+from .outbox import process_outbox
+from .retry import get_retry_policy
 
 
 def get_db_path():
-    db_path = os.environ.get("MAILADM_DB", "/mailadm/docker-data/mailadm.db")
-    try:
-        sqlite3.connect(db_path)
-    except sqlite3.OperationalError:
+    db_path = Path(os.environ.get("MAILADM_DB", "/mailadm/docker-data/mailadm.db"))
+    if not db_path.parent.is_dir():
         raise RuntimeError("mailadm.db not found: MAILADM_DB not set")
-    return Path(db_path)
+    return db_path
+
+
+def get_lock_timeout():
+    """How many seconds a writer waits for the database before giving up."""
+    return float(os.environ.get("MAILADM_DB_LOCK_TIMEOUT", 60))
+
+
+def get_pool_size():
+    """How many idle sqlite connections each process keeps per database and mode."""
+    return int(os.environ.get("MAILADM_DB_POOLSIZE", 8))
+
+
+# "default" is sqlite's own behaviour; "performance" lets readers and writers work
+# concurrently (WAL) and only syncs to disk at checkpoints, so the last transactions may
+# be lost on a power failure. Each value can be overridden with
+# an environment variable like MAILADM_SQLITE_CACHE_SIZE.
+SQLITE_PROFILES = {
+    "default": {
+        "journal_mode": "delete",
+        "synchronous": "full",
+        "mmap_size": 0,
+        "cache_size": -2000,
+    },
+    "performance": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "mmap_size": 64 * 1024 * 1024,
+        "cache_size": -16000,
+    },
+}
+
+
+def get_sqlite_profile():
+    """Return the sqlite pragmas which mailadm applies to its database connections."""
+    name = os.environ.get("MAILADM_SQLITE_PROFILE", "default")
+    try:
+        profile = dict(SQLITE_PROFILES[name])
+    except KeyError:
+        raise RuntimeError("unknown MAILADM_SQLITE_PROFILE: {!r}".format(name))
+    profile["busy_timeout"] = int(get_lock_timeout() * 1000)
+    for pragma in profile:
+        value = os.environ.get("MAILADM_SQLITE_" + pragma.upper())
+        if value is not None:
+            profile[pragma] = value
+    return profile
+
+
+def apply_sqlite_profile(sqlconn, write):
+    # the journal mode is stored in the database file, DB.ensure_tables() sets it
+    for pragma, value in get_sqlite_profile().items():
+        if pragma != "journal_mode":
+            sqlconn.execute("PRAGMA {}={}".format(pragma, value))
+
+
+# functions which are called with (sqlconn, write) once for every new sqlite connection
+connection_hooks = [apply_sqlite_profile]
+
+
+def add_connection_hook(hook):
+    """Register a function which sets up every new sqlite connection.
+
+    :param hook: a function which gets the sqlite3 connection and whether it is writable
+    """
+    connection_hooks.append(hook)
+    # idle connections were set up without the new hook
+    with _registry_lock:
+        for pool in _pools.values():
+            pool.clear()
+
+
+class ConnectionPool:
+    """Keep idle sqlite connections of one database and mode for reuse.
+
+    :param connect: a function which opens and sets up a new sqlite3 connection
+    :param maxsize: how many idle connections are kept at most
+    """
+
+    def __init__(self, connect, maxsize):
+        self._connect = connect
+        self.maxsize = maxsize
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def put(self, sqlconn):
+        if sqlconn.in_transaction:
+            sqlconn.rollback()
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(sqlconn)
+                return
+        sqlconn.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for sqlconn in idle:
+            sqlconn.close()
+
+
+class FifoLock:
+    """A lock which is granted to the waiting threads in the order they asked for it."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        self._abandoned = set()
+        self.owner = None
+
+    def acquire(self, timeout=None):
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            if self._cond.wait_for(lambda: self._serving == ticket, timeout):
+                self.owner = threading.get_ident()
+                return True
+            # let release() skip our ticket once it is our turn
+            self._abandoned.add(ticket)
+            return False
+
+    def release(self):
+        with self._cond:
+            self.owner = None
+            self._serving += 1
+            while self._serving in self._abandoned:
+                self._abandoned.remove(self._serving)
+                self._serving += 1
+            self._cond.notify_all()
+
+
+class GroupCommitWriter:
+    """Run small write jobs in a dedicated thread and commit them in groups.
+
+    Jobs which are submitted while a group is being committed are collected and run in
+    the next transaction, in the order they were submitted. Each job runs in its own
+    savepoint, so a failing job doesn't affect the other jobs of its group.
+
+    :param db: the DB to write to
+    :param max_group: the maximum number of jobs committed with one transaction
+    """
+
+    def __init__(self, db, max_group=64):
+        self.db = db
+        self.max_group = max_group
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        """Schedule a job for the next group commit.
+
+        :param job: a function which gets a write Connection and returns a result
+        :return: a Future which gets the result of the job once it was committed
+        """
+        future = Future()
+        self._queue.put((job, future))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name="db-writer")
+                self._thread.start()
+        return future
+
+    def _run(self):
+        while 1:
+            group = [self._queue.get()]
+            while len(group) < self.max_group:
+                try:
+                    group.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(group)
+
+    def _commit(self, group):
+        try:
+            conn = self.db.get_connection(write=True)
+        except Exception as e:
+            for job, future in group:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            return
+        # jobs can be cancelled while they wait for the lock, e.g. by a deadline
+        group = [(job, future) for job, future in group if future.set_running_or_notify_cancel()]
+        results = []
+        try:
+            for job, future in group:
+                conn.execute("SAVEPOINT job")
+                try:
+                    results.append((future, job(conn), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    results.append((future, None, e))
+                conn.execute("RELEASE job")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            results = [(future, None, e) for job, future in group]
+        finally:
+            conn.close()
+        for future, result, exc in results:
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+
+# per-process state of each database path
+_write_locks = {}
+_writers = {}
+_pools = {}
+_registry_lock = threading.Lock()
+
+
+def _reset_registry():
+    # locks, writer threads and sqlite connections must not be shared with forked workers
+    global _registry_lock
+    _write_locks.clear()
+    _writers.clear()
+    _pools.clear()
+    _registry_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_registry)
 
 
 class DB:
+    #: a mailadm.retry.RetryPolicy for account creation; the process-wide one if None
+    retry_policy = None
+
     def __init__(self, path, autoinit=True):
         self.path = path
         self.ensure_tables()
 
-    def get_connection(self, write=False, closing=False):
-        # we let the database serialize all writers at connection time
-        # to play it very safe (we don't have massive amounts of writes).
+    @property
+    def write_lock(self):
+        """The lock which serializes the writers of this process in FIFO order."""
+        with _registry_lock:
+            return _write_locks.setdefault(str(self.path), FifoLock())
+
+    @property
+    def writer(self):
+        with _registry_lock:
+            writer = _writers.get(str(self.path))
+            if writer is None:
+                writer = _writers[str(self.path)] = GroupCommitWriter(self)
+            return writer
+
+    def get_pool(self, write):
+        """The pool of idle sqlite connections of this process, for reading or writing."""
+        key = (str(self.path), write)
+        with _registry_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(lambda: self._connect(write), get_pool_size())
+            return pool
+
+    def _connect(self, write):
         mode = "ro"
         if write:
             mode = "rw"
         if not self.path.exists():
             mode = "rwc"
         uri = "file:%s?mode=%s" % (self.path, mode)
-        sqlconn = sqlite3.connect(uri, timeout=60, isolation_level=None, uri=True)
+        sqlconn = sqlite3.connect(uri, timeout=get_lock_timeout(), isolation_level=None,
+                                  uri=True, check_same_thread=False)
+        for hook in connection_hooks:
+            hook(sqlconn, write)
+        return sqlconn
 
+    def get_connection(self, write=False, closing=False, deadline=None):
+        # writers of this process queue up in FIFO order for the write lock,
+        # writers of other processes are serialized by sqlite's busy timeout.
+        lock = None
         if write:
-            start_time = time.time()
-            while 1:
-                try:
-                    sqlconn.execute("begin immediate")
-                    break
-                except sqlite3.OperationalError:
-                    # another thread may be writing, give it a chance to finish
-                    time.sleep(0.1)
-                    if time.time() - start_time > 5:
-                        # if it takes this long, something is wrong
-                        raise
-        conn = Connection(sqlconn, self.path, write=write)
+            lock = self.write_lock
+            if lock.owner == threading.get_ident():
+                raise RuntimeError("this thread already has a write connection")
+            timeout = get_lock_timeout()
+            if deadline is not None:
+                timeout = deadline.get_timeout(maximum=timeout, what="locking the database")
+            with mailadm.metrics.db_lock_wait_seconds.time(), mailadm.tracing.span("db.lock"):
+                locked = lock.acquire(timeout=timeout)
+            if not locked:
+                if deadline is not None and deadline.remaining() <= 0:
+                    raise DeadlineExceeded("deadline exceeded while locking the database")
+                raise DBError("timeout while waiting for the database write lock")
+        pool = self.get_pool(write)
+        try:
+            sqlconn = pool.get()
+            if write:
+                sqlconn.execute("begin immediate")
+        except Exception:
+            if lock is not None:
+                lock.release()
+            raise
+
+        def release(sqlconn):
+            pool.put(sqlconn)
+            if lock is not None:
+                lock.release()
+
+        conn = Connection(sqlconn, self.path, write=write, release=release)
         if closing:
             conn = contextlib.closing(conn)
         return conn
 
     @contextlib.contextmanager
-    def write_transaction(self):
-        conn = self.get_connection(closing=False, write=True)
-        try:
-            yield conn
-        except Exception:
-            conn.rollback()
-            conn.close()
-            raise
-        else:
-            conn.commit()
-            conn.close()
+    def write_transaction(self, deadline=None):
+        with mailadm.tracing.span("db.write_transaction"):
+            conn = self.get_connection(closing=False, write=True, deadline=deadline)
+            try:
+                yield conn
+            except Exception:
+                conn.rollback()
+                conn.close()
+                raise
+            else:
+                conn.commit()
+                conn.close()
+
+    def write(self, job, deadline=None):
+        """Run a small write job with the group-commit writer and wait for its result.
+
+        :param job: a function which gets a write Connection and returns a result
+        :param deadline: a mailadm.util.Deadline; if it runs out before the job started,
+            the job is cancelled and DeadlineExceeded is raised
+        """
+        if self.write_lock.owner == threading.get_ident():
+            raise RuntimeError("write() would deadlock inside a write transaction")
+        with mailadm.tracing.span("db.write"):
+            future = self.writer.submit(job)
+            if deadline is None:
+                return future.result()
+            try:
+                return future.result(timeout=max(0, deadline.remaining()))
+            except FutureTimeoutError:
+                if future.cancel():
+                    raise DeadlineExceeded("deadline exceeded while waiting for the database")
+                # the job is already running, it won't take long
+                return future.result()
 
     def read_connection(self, closing=True):
         return self.get_connection(closing=closing, write=False)
 
+    def add_email_account_tries(self, token_info, addr=None, password=None, tries=1,
+                                deadline=None):
+        """Add an email account without holding the database lock during mailcow requests.
+
+        A token use and the address are reserved in a short transaction, then the mailbox is
+        created in mailcow, and finally the user is confirmed - or, if mailcow failed, the
+        reservation is released again. If the token has a pool of pre-created mailboxes,
+        one of them is activated instead of creating a new one.
+
+        :param token_info: the token which authorizes the new user creation
+        :param addr: email address for the new account; randomly generated if omitted
+        :param password: password for the new account; randomly generated if omitted
+        :param tries: how often to try at most; see mailadm.retry for which errors are retried
+        :param deadline: a mailadm.util.Deadline which limits the time spent waiting for the
+            database lock and for mailcow; DeadlineExceeded is raised when it runs out
+        :return: a UserInfo object with the database information about the new user, plus password
+        """
+        # fail fast without touching the database while mailcow is known to be down
+        get_circuit_breaker(token_info.config.mailcow_endpoint).check()
+        policy = self.retry_policy or get_retry_policy()
+        attempts = itertools.count(1)
+
+        def attempt():
+            with mailadm.tracing.span("add_email_account", attempt=next(attempts)):
+                return self._add_email_account(token_info, addr=addr, password=password,
+                                               deadline=deadline)
+        # only a new random address can avoid a collision
+        return policy.run(attempt, tries, deadline=deadline, collisions=addr is None)
+
+    def _add_email_account(self, token_info, addr, password, deadline=None):
+        def reserve(conn):
+            pooled = None
+            if addr is None and password is None:
+                pooled = conn.claim_pool_account(token_info.name)
+            user_info = conn.reserve_email_account(
+                token_info, addr=addr if pooled is None else pooled,
+                check_mailbox=pooled is None)
+            # if this process dies, the outbox worker cleans up after the reservation expired
+            conn.add_outbox("create", user_info.addr, token_info.name, delay=PENDING_TTL)
+            # the reservation already checked the local mirror, if it is fresh enough
+            check_mailcow = not conn.is_mailbox_mirror_fresh()
+            return user_info, pooled, check_mailcow, conn.get_mailcow_connection(deadline)
+
+        user_info, pooled, check_mailcow, mailcow = self.write(reserve, deadline=deadline)
+        if password is None:
+            password = mailadm.util.gen_password()
+
+        try:
+            if pooled is not None:
+                mailcow.activate_user_mailcow(user_info.addr, password)
+            else:
+                if check_mailcow and mailcow.get_user(user_info.addr):
+                    raise MailcowError("account does already exist")
+                mailcow.add_user_mailcow(user_info.addr, password, token_info.name)
+        except Exception as e:
+            # e.g. after a timeout, mailcow might have created the mailbox anyway
+            uncertain = pooled is None and not isinstance(e, MailcowError)
+
+            def release(conn):
+                conn.release_email_account(user_info.addr)
+                if pooled is not None:
+                    conn.add_pool_account(token_info, addr=user_info.addr, ready=True)
+                if uncertain:
+                    conn.add_outbox("create", user_info.addr, token_info.name)
+                else:
+                    conn.del_outbox([user_info.addr])
+            self.write(release)
+            raise
+
+        # the mailbox exists now, so confirming it isn't cut short by the deadline
+        def confirm(conn):
+            confirmed = conn.confirm_email_account(user_info.addr,
+                                                   ttl=token_info.get_expiry_seconds())
+            conn.add_mailbox_mirror(user_info.addr, token_info.name)
+            conn.del_outbox([user_info.addr])
+            return confirmed
+
+        try:
+            user_info = self.write(confirm)
+        except UserNotFound:
+            # the outbox worker already released the reservation, don't leave an orphaned
+            # mailbox behind
+            self.write(lambda conn: conn.add_outbox("delete", user_info.addr))
+            process_outbox(self, addrs=[user_info.addr])
+            raise
+        user_info.password = password
+        return user_info
+
+    def refresh_mailbox_mirror(self):
+        """Download the list of mailcow mailboxes into the local mirror."""
+        with self.read_connection() as conn:
+            mailcow = conn.get_mailcow_connection()
+        refreshed = int(time.time())
+        mcusers = mailcow.get_user_list()
+        with self.write_transaction() as conn:
+            conn.set_mailbox_mirror(mcusers, refreshed)
+
     def init_config(self, mail_domain, web_endpoint, mailcow_endpoint, mailcow_token):
         with self.write_transaction() as conn:
             conn.set_config("mail_domain", mail_domain)
@@ -81,13 +486,54 @@ class DB:
         with self.read_connection() as conn:
             return conn.config
 
-    CURRENT_DBVERSION = 1
+    CURRENT_DBVERSION = 11
 
     def ensure_tables(self):
+        self.ensure_journal_mode()
         with self.read_connection() as conn:
-            if conn.get_dbversion():
+            if conn.get_dbversion() == self.CURRENT_DBVERSION:
                 return
         with self.write_transaction() as conn:
+            self.upgrade_tables(conn)
+
+    def ensure_journal_mode(self):
+        # the journal mode can't be changed inside of a transaction
+        mode = str(get_sqlite_profile()["journal_mode"]).lower()
+        with self.read_connection() as conn:
+            if conn.execute("PRAGMA journal_mode").fetchone()[0] == mode:
+                return
+        self.get_pool(write=False).clear()
+        self.get_pool(write=True).clear()
+        sqlconn = self._connect(write=True)
+        try:
+            sqlconn.execute("PRAGMA journal_mode={}".format(mode))
+        except sqlite3.OperationalError as e:
+            # leaving WAL mode needs all other connections to be closed
+            print("DB: could not set journal mode {}: {}".format(mode, e), file=sys.stderr)
+        finally:
+            sqlconn.close()
+
+    def check_sqlite_profile(self):
+        """Compare the sqlite settings of a database connection with the configured profile.
+
+        :return: a list of (pragma, expected value, actual value) tuples
+        """
+        result = []
+        with self.read_connection() as conn:
+            for pragma, expected in get_sqlite_profile().items():
+                actual = conn.execute("PRAGMA {}".format(pragma)).fetchone()[0]
+                if pragma == "synchronous":
+                    actual = ["off", "normal", "full", "extra"][actual]
+                result.append((pragma, str(expected).lower(), str(actual).lower()))
+        return result
+
+    def upgrade_tables(self, conn):
+        """Create the tables or migrate them to CURRENT_DBVERSION.
+
+        :param conn: a write connection; the caller commits the transaction.
+        """
+        dbversion = conn.get_dbversion()
+        if not dbversion:
             print("DB: Creating tables", self.path)
 
             conn.execute("""
@@ -115,4 +561,100 @@ class DB:
                     value TEXT
                 )
             """)
-            conn.set_config("dbversion", self.CURRENT_DBVERSION)
+            dbversion = 1
+        for version in range(dbversion + 1, self.CURRENT_DBVERSION + 1):
+            print("DB: Migrating tables to version", version, self.path)
+            getattr(self, "_migrate_to_%d" % (version,))(conn)
+        conn.set_config("dbversion", self.CURRENT_DBVERSION)
+
+    def _migrate_to_2(self, conn):
+        # timestamp at which a prune run claimed the user for deletion
+        conn.execute("ALTER TABLE users ADD COLUMN prune_claim INTEGER")
+
+    def _migrate_to_3(self, conn):
+        # users whose signup is still in progress
+        conn.execute("ALTER TABLE users ADD COLUMN pending INTEGER NOT NULL DEFAULT 0")
+
+    def _migrate_to_4(self, conn):
+        # stored expiry time, so prune can use an index instead of scanning all users
+        conn.execute("ALTER TABLE users ADD COLUMN expires_at INTEGER")
+        conn.execute("UPDATE users SET expires_at = "
+                     "CASE WHEN ttl > ? - date THEN ? ELSE date + ttl END",
+                     (sys.maxsize, sys.maxsize))
+        conn.execute("CREATE INDEX users_expires_at ON users (expires_at)")
+
+    def _migrate_to_5(self, conn):
+        # counters like the generation of the tokens table, for invalidating caches
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+        """)
+
+    def _migrate_to_6(self, conn):
+        # local mirror of the mailcow mailboxes, see Connection.get_mailcow_users()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS mailboxes (
+                addr TEXT PRIMARY KEY,
+                token TEXT,
+                updated INTEGER NOT NULL
+            )
+        """)
+
+    def _migrate_to_7(self, conn):
+        # inactive mailboxes which were created in advance, see mailadm.pool
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS account_pool (
+                addr TEXT PRIMARY KEY,
+                token_name TEXT NOT NULL,
+                created INTEGER NOT NULL,
+                ready INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+    def _migrate_to_8(self, conn):
+        # status of the background services, written by the supervisor in the gunicorn master
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS services (
+                name TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                restarts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                since INTEGER
+            )
+        """)
+
+    def _migrate_to_9(self, conn):
+        # mailcow mailboxes which are to be created or deleted, see mailadm.outbox
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                addr TEXT PRIMARY KEY,
+                action TEXT NOT NULL,
+                token_name TEXT,
+                created INTEGER NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt INTEGER NOT NULL,
+                error TEXT,
+                dead INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS outbox_next_attempt ON outbox (dead, next_attempt)
+        """)
+
+    def _migrate_to_10(self, conn):
+        # signups per minute, see mailadm.ratelimit; migrate-db runs this again
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(tokens)")]
+        if "rate" not in columns:
+            conn.execute("ALTER TABLE tokens ADD COLUMN rate REAL")
+
+    def _migrate_to_11(self, conn):
+        # pool accounts don't keep their passwords anymore, activating them sets a new one
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(account_pool)")]
+        if "password" in columns:
+            conn.execute("ALTER TABLE account_pool RENAME TO account_pool_old")
+            self._migrate_to_7(conn)
+            conn.execute("""INSERT INTO account_pool (addr, token_name, created, ready)
+                            SELECT addr, token_name, created, ready FROM account_pool_old""")
+            conn.execute("DROP TABLE account_pool_old")
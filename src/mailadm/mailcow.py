@@ -1,4 +1,161 @@
+import collections
+import os
+import threading
+import time
+
 import requests as r
+from requests.adapters import HTTPAdapter
+
+import mailadm.metrics
+import mailadm.tracing
+from mailadm.util import DeadlineExceeded
+
+DEFAULT_POOLSIZE = 10
+
+_sessions = {}
+_breakers = {}
+_sessions_lock = threading.Lock()
+
+
+def _reset_sessions():
+    # pooled sockets and the circuit breaker state must not be shared with forked
+    # gunicorn workers
+    global _sessions_lock
+    _sessions.clear()
+    _breakers.clear()
+    _sessions_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_sessions)
+
+
+def get_session(mailcow_endpoint):
+    """Return the process-wide HTTP session for a mailcow endpoint.
+
+    The session keeps its connections alive, so web requests, the prune thread and the bot
+    reuse them instead of doing a new TCP/TLS handshake for every API call. The size of the
+    connection pool can be set with the MAILCOW_POOLSIZE environment variable.
+    """
+    with _sessions_lock:
+        session = _sessions.get(mailcow_endpoint)
+        if session is None:
+            poolsize = int(os.environ.get("MAILCOW_POOLSIZE", DEFAULT_POOLSIZE))
+            adapter = HTTPAdapter(pool_connections=poolsize, pool_maxsize=poolsize)
+            session = r.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[mailcow_endpoint] = session
+        return session
+
+
+def get_timeout():
+    """How many seconds a mailcow API call may take at most."""
+    return float(os.environ.get("MAILCOW_TIMEOUT", 30))
+
+
+def get_circuit_breaker(mailcow_endpoint):
+    """Return the process-wide circuit breaker for a mailcow endpoint."""
+    with _sessions_lock:
+        breaker = _breakers.get(mailcow_endpoint)
+        if breaker is None:
+            breaker = _breakers[mailcow_endpoint] = CircuitBreaker()
+        return breaker
+
+
+class CircuitBreaker:
+    """Stop calling mailcow for a while when too many calls fail or are too slow.
+
+    The breaker is closed while mailcow is healthy. It opens when at least min_calls
+    calls were made in the last window seconds and the share of failed calls reached
+    threshold; a call counts as failed if it raised a requests exception, got a 5xx
+    response or took longer than slow seconds. While it is open, calls fail right away
+    with MailcowUnavailable. After cooldown seconds, it is half-open and lets one probe
+    call through, which closes it again or keeps it open for another cooldown.
+
+    The defaults can be set with the MAILCOW_BREAKER_* environment variables.
+    """
+
+    def __init__(self, threshold=None, min_calls=None, window=None, slow=None, cooldown=None):
+        env = os.environ.get
+        self.threshold = float(env("MAILCOW_BREAKER_THRESHOLD", 0.5)) \
+            if threshold is None else threshold
+        self.min_calls = int(env("MAILCOW_BREAKER_MIN_CALLS", 10)) \
+            if min_calls is None else min_calls
+        self.window = float(env("MAILCOW_BREAKER_WINDOW", 60)) if window is None else window
+        self.slow = float(env("MAILCOW_BREAKER_SLOW", 10)) if slow is None else slow
+        self.cooldown = float(env("MAILCOW_BREAKER_COOLDOWN", 30)) \
+            if cooldown is None else cooldown
+        self.state = "closed"
+        self.opened_at = None
+        self._probing = False
+        self._calls = collections.deque()
+        self._lock = threading.Lock()
+
+    def get_retry_after(self):
+        """Seconds until the breaker lets a probe through, 0 if it is not open."""
+        if self.state != "open":
+            return 0
+        return max(0, self.opened_at + self.cooldown - time.monotonic())
+
+    def check(self):
+        """Raise MailcowUnavailable if a call would be rejected right now."""
+        if self.get_retry_after() > 0:
+            raise MailcowUnavailable(self.get_retry_after())
+        if self.state == "half-open" and self._probing:
+            raise MailcowUnavailable(self.cooldown)
+
+    def before_call(self):
+        """Raise MailcowUnavailable if the call must not be made now."""
+        with self._lock:
+            if self.state == "open":
+                if self.get_retry_after() > 0:
+                    raise MailcowUnavailable(self.get_retry_after())
+                self.state = "half-open"
+            if self.state == "half-open":
+                if self._probing:
+                    raise MailcowUnavailable(self.cooldown)
+                self._probing = True
+
+    def after_call(self, ok, latency):
+        now = time.monotonic()
+        ok = ok and latency < self.slow
+        with self._lock:
+            if self.state == "open":
+                # a call which started before the breaker opened
+                return
+            if self.state == "half-open":
+                self._probing = False
+                self._calls.clear()
+                if ok:
+                    self.state = "closed"
+                else:
+                    self.state, self.opened_at = "open", now
+                return
+            self._calls.append((now, ok))
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._calls.popleft()
+            failed = sum(1 for t, success in self._calls if not success)
+            if len(self._calls) >= self.min_calls and \
+                    failed >= self.threshold * len(self._calls):
+                self.state, self.opened_at = "open", now
+                self._calls.clear()
+
+    def call(self, func, *args, **kwargs):
+        """Call func, which does a request to mailcow, through the breaker."""
+        self.before_call()
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except r.exceptions.RequestException:
+            self.after_call(False, time.monotonic() - start)
+            raise
+        except BaseException:
+            # not mailcow's fault; don't leave a half-open breaker probing forever
+            self.after_call(True, 0)
+            raise
+        self.after_call(result.status_code < 500, time.monotonic() - start)
+        return result
 
 
 class MailcowConnection:
@@ -7,17 +164,44 @@ class MailcowConnection:
     :param mailcow_endpoint: the URL to the mailcow API
     :param mailcow_token: the access token to the mailcow API
     """
-    def __init__(self, mailcow_endpoint, mailcow_token):
+    def __init__(self, mailcow_endpoint, mailcow_token, deadline=None):
         self.mailcow_endpoint = mailcow_endpoint
         self.auth = {"X-API-Key": mailcow_token}
+        self.deadline = deadline
+        self.session = get_session(mailcow_endpoint)
+        self.breaker = get_circuit_breaker(mailcow_endpoint)
+
+    def _request(self, func, url, **kwargs):
+        timeout = get_timeout()
+        if self.deadline is not None:
+            timeout = self.deadline.get_timeout(maximum=timeout, what="calling " + url)
+        # e.g. "get/mailbox" for get/mailbox/<addr>, but "get/mailbox/all"
+        parts = url[len(self.mailcow_endpoint):].split("/")
+        endpoint = "/".join(parts[:3] if parts[2:3] == ["all"] else parts[:2])
+        try:
+            with mailadm.metrics.mailcow_request_seconds.time(endpoint=endpoint), \
+                    mailadm.tracing.span("mailcow", endpoint=endpoint):
+                return self.breaker.call(func, url, headers=self.auth, timeout=timeout,
+                                         **kwargs)
+        except r.exceptions.Timeout as e:
+            if self.deadline is not None and self.deadline.remaining() <= 0:
+                raise DeadlineExceeded("deadline exceeded while calling " + url) from e
+            raise
+
+    def _post(self, url, **kwargs):
+        return self._request(self.session.post, url, **kwargs)
 
-    def add_user_mailcow(self, addr, password, token, quota=0):
+    def _get(self, url, **kwargs):
+        return self._request(self.session.get, url, **kwargs)
+
+    def add_user_mailcow(self, addr, password, token, quota=0, active=True):
         """HTTP Request to add a user to the mailcow instance.
 
         :param addr: the email address of the new account
         :param password: the password  of the new account
         :param token: the mailadm token used for account creation
         :param quota: the maximum mailbox storage in MB. default: unlimited
+        :param active: whether the user can log in right away
         """
         url = self.mailcow_endpoint + "add/mailbox"
         payload = {
@@ -26,13 +210,26 @@ class MailcowConnection:
             "quota": quota,
             "password": password,
             "password2": password,
-            "active": True,
+            "active": active,
             "force_pw_update": False,
             "tls_enforce_in": False,
             "tls_enforce_out": False,
             "tags": ["mailadm:" + token]
         }
-        result = r.post(url, json=payload, headers=self.auth, timeout=30)
+        result = self._post(url, json=payload)
+        if type(result.json()) != list or result.json()[0].get("type") != "success":
+            raise MailcowError(result.json())
+
+    def activate_user_mailcow(self, addr, password):
+        """HTTP Request to activate a mailbox which was created inactive.
+
+        :param addr: the email account to be activated
+        :param password: the new password of the account
+        """
+        url = self.mailcow_endpoint + "edit/mailbox"
+        payload = {"items": [addr],
+                   "attr": {"active": "1", "password": password, "password2": password}}
+        result = self._post(url, json=payload)
         if type(result.json()) != list or result.json()[0].get("type") != "success":
             raise MailcowError(result.json())
 
@@ -42,15 +239,49 @@ class MailcowConnection:
         :param addr: the email account to be deleted
         """
         url = self.mailcow_endpoint + "delete/mailbox"
-        result = r.post(url, json=[addr], headers=self.auth)
+        result = self._post(url, json=[addr])
         json = result.json()
         if not isinstance(json, list) or json[0].get("type" != "success"):
             raise MailcowError(json)
 
+    def del_users_mailcow(self, addrs):
+        """HTTP Request to delete several users from the mailcow instance at once.
+
+        :param addrs: the email accounts to be deleted
+        :return: a dict mapping each address which still exists in mailcow to its error
+        """
+        url = self.mailcow_endpoint + "delete/mailbox"
+        result = self._post(url, json=list(addrs))
+        json = result.json()
+        if not isinstance(json, list):
+            raise MailcowError(json)
+        deleted = set()
+        errors = {}
+        for entry in json:
+            msg = entry.get("msg")
+            addr = msg[1] if isinstance(msg, list) and len(msg) > 1 else None
+            if entry.get("type") == "success":
+                deleted.add(addr)
+            else:
+                errors[addr] = msg
+        if not errors:
+            return {}
+        # mailcow names the mailbox in most of its messages, but not in all of them
+        failed = {addr: errors.get(addr, errors.get(None, "not deleted"))
+                  for addr in addrs if addr not in deleted}
+        # a mailbox which doesn't exist (anymore) counts as deleted
+        for addr in list(failed):
+            try:
+                if self.get_user(addr) is None:
+                    del failed[addr]
+            except MailcowError:
+                pass
+        return failed
+
     def get_user(self, addr):
         """HTTP Request to get a specific mailcow user (not only mailadm-generated ones)."""
         url = self.mailcow_endpoint + "get/mailbox/" + addr
-        result = r.get(url, headers=self.auth)
+        result = self._get(url)
         json = result.json()
         if json == {}:
             return None
@@ -62,7 +293,7 @@ class MailcowConnection:
     def get_user_list(self):
         """HTTP Request to get all mailcow users (not only mailadm-generated ones)."""
         url = self.mailcow_endpoint + "get/mailbox/all"
-        result = r.get(url, headers=self.auth)
+        result = self._get(url)
         json = result.json()
         if json == {}:
             return []
@@ -76,11 +307,29 @@ class MailcowUser(object):
     def __init__(self, json):
         self.addr = json.get("username")
         self.quota = json.get("quota")
+        self.token = None
         for tag in json.get("tags", []):
-            if "mailadm:" in tag:
-                self.token = tag.strip("mailadm:")
+            if tag.startswith("mailadm:"):
+                self.token = tag[len("mailadm:"):]
                 break
 
+    @classmethod
+    def from_mirror(cls, addr, token):
+        """Create a MailcowUser from a row of mailadm's local mailbox mirror."""
+        user = cls({"username": addr})
+        user.token = token
+        return user
+
 
 class MailcowError(Exception):
     """This is thrown if a Mailcow operation fails."""
+
+
+class MailcowUnavailable(MailcowError):
+    """The circuit breaker is open, mailcow isn't called right now.
+
+    :param retry_after: seconds after which mailcow is called again
+    """
+    def __init__(self, retry_after):
+        super().__init__("mailcow is unavailable, retry after {:.0f} seconds".format(retry_after))
+        self.retry_after = retry_after
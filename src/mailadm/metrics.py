@@ -0,0 +1,259 @@
+"""
+count and time what mailadm does, for the /metrics endpoint in Prometheus text format.
+
+Observations are summed up in the memory of each process, and a background thread adds
+the sums to a small sqlite database next to mailadm.db every MAILADM_METRICS_INTERVAL
+seconds, so the /metrics endpoint of any gunicorn worker shows the sums over all workers
+and the background threads of the master process, without a database write per
+observation. Until enable() is called, which the web app only does if MAILADM_METRICS is
+set, observations are dropped.
+"""
+import atexit
+import contextlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+_store = None
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def get_metrics_db_path(db_path):
+    """Return the path of the metrics database, next to mailadm.db by default."""
+    path = os.environ.get("MAILADM_METRICS_DB")
+    if path:
+        return Path(path)
+    db_path = Path(db_path)
+    return db_path.with_name(db_path.stem + "-metrics.db")
+
+
+def get_serve_metrics():
+    """Whether the web app records metrics and serves them at /metrics.
+
+    Off by default, because /metrics shows the names and usage of all tokens.
+    """
+    return bool(int(os.environ.get("MAILADM_METRICS", 0)))
+
+
+def get_flush_interval():
+    """Seconds between two writes of the observations of a process to the database."""
+    return float(os.environ.get("MAILADM_METRICS_INTERVAL", 10))
+
+
+def enable(path):
+    """Record the observations of this process in the metrics database at path."""
+    global _store
+    if _store is not None:
+        _store.flush()
+    _store = MetricsStore(path)
+
+
+class MetricsStore:
+    """The sums of all observations, shared by all processes which use the same path."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS samples (
+                    family TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    PRIMARY KEY (name, labels)
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA synchronous = OFF")
+        return contextlib.closing(conn)
+
+    def add(self, samples):
+        """Add values to samples, given as (family, name, labels, value) tuples.
+
+        The values are kept in memory until the next flush().
+        """
+        with self._lock:
+            for family, name, labels, value in samples:
+                key = (family, name, labels)
+                self._pending[key] = self._pending.get(key, 0) + value
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_periodically,
+                                                 name="metrics-flush", daemon=True)
+                self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(get_flush_interval())
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                # the sums stay pending and are written with the next flush
+                print("failed to write metrics to {}: {}".format(self.path, e),
+                      file=sys.stderr)
+
+    def flush(self):
+        """Add the values which this process observed since the last flush to the database."""
+        q = """INSERT INTO samples (family, name, labels, value) VALUES (?, ?, ?, ?)
+               ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            with self._connect() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(q, [key + (value,) for key, value in pending.items()])
+                conn.execute("COMMIT")
+        except sqlite3.Error:
+            with self._lock:
+                for key, value in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + value
+            raise
+
+    def _after_fork(self):
+        # the parent process writes its own observations, and its thread isn't copied
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def get_samples(self):
+        """Return (family, name, labels, value) tuples, grouped by family."""
+        q = "SELECT family, name, labels, value FROM samples ORDER BY family, rowid"
+        self.flush()
+        with self._connect() as conn:
+            return conn.execute(q).fetchall()
+
+
+def format_labels(labels):
+    return ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                                     .replace("\n", "\\n").replace('"', '\\"'))
+                    for name, value in sorted(labels.items()))
+
+
+def format_sample(name, labels, value):
+    if labels:
+        name += "{" + labels + "}"
+    return "{} {}".format(name, repr(float(value)))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        _metrics.append(self)
+
+    def _add(self, samples):
+        if _store is not None:
+            _store.add([(self.name,) + sample for sample in samples])
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        self._add([(self.name + "_total", format_labels(labels), amount)])
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        samples = []
+        for bucket in self.buckets:
+            le = "+Inf" if bucket == float("inf") else repr(float(bucket))
+            samples.append((self.name + "_bucket", format_labels(dict(labels, le=le)),
+                            int(value <= bucket)))
+        labels = format_labels(labels)
+        samples.append((self.name + "_sum", labels, value))
+        samples.append((self.name + "_count", labels, 1))
+        self._add(samples)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe how many seconds the with-block takes."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+
+_metrics = []
+
+signup_seconds = Histogram(
+    "mailadm_signup_seconds", "Duration of POST / requests by status code")
+mailcow_request_seconds = Histogram(
+    "mailadm_mailcow_request_seconds", "Duration of mailcow API calls by endpoint")
+db_lock_wait_seconds = Histogram(
+    "mailadm_db_lock_wait_seconds", "Time spent waiting for the database write lock")
+prune_batch_size = Histogram(
+    "mailadm_prune_batch_size", "Number of accounts deleted per prune batch",
+    buckets=(1, 5, 10, 50, 100, 500, 1000))
+prune_batch_seconds = Histogram(
+    "mailadm_prune_batch_seconds", "Duration of prune batches")
+retries = Counter(
+    "mailadm_retries", "Failed account creation attempts by error class and result")
+
+
+def _after_fork():
+    if _store is not None:
+        _store._after_fork()
+
+
+def _flush_at_exit():
+    if _store is not None:
+        try:
+            _store.flush()
+        except sqlite3.Error as e:
+            print("failed to write metrics to {}: {}".format(_store.path, e), file=sys.stderr)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+atexit.register(_flush_at_exit)
+
+
+def render_samples():
+    """Yield the lines of the recorded metrics in Prometheus text format.
+
+    The observations of this process are written first; those of other processes show up
+    after their next flush.
+    """
+    samples = {}
+    if _store is not None:
+        for family, name, labels, value in _store.get_samples():
+            samples.setdefault(family, []).append(format_sample(name, labels, value))
+    for metric in _metrics:
+        yield "# HELP {} {}".format(metric.name, metric.help)
+        yield "# TYPE {} {}".format(metric.name, metric.type)
+        yield from samples.get(metric.name, [])
+
+
+def render(db):
+    """Return all metrics in Prometheus text format, with the token gauges of db."""
+    lines = list(render_samples())
+    with db.read_connection() as conn:
+        usage = conn.get_token_usage()
+    for i, (name, help) in enumerate([("mailadm_token_usecount", "Accounts created per token"),
+                                      ("mailadm_token_maxuse", "Maximum accounts per token")]):
+        lines.append("# HELP {} {}".format(name, help))
+        lines.append("# TYPE {} gauge".format(name))
+        for row in usage:
+            lines.append(format_sample(name, format_labels(dict(token=row[0])), row[i + 1]))
+    return "\n".join(lines) + "\n"
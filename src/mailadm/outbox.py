@@ -0,0 +1,102 @@
+"""
+deliver the mailcow side effects which were recorded in the outbox table.
+
+The deletion of a mailbox is recorded in the same transaction which deletes its user,
+the creation of a mailbox in the same transaction which reserves the user. Whoever
+recorded an entry processes it right away; if that fails or the process dies, the outbox
+worker retries it with exponential backoff, and gives it up as a dead letter after
+MAILADM_OUTBOX_MAX_ATTEMPTS attempts.
+
+Processing an entry is idempotent: a mailbox which doesn't exist counts as deleted. A
+"create" entry is only left behind by a signup which didn't finish; the worker removes
+the mailbox it might have created and releases the reservation.
+"""
+import os
+import sys
+import time
+
+from mailadm.mailcow import MailcowError
+from requests.exceptions import RequestException
+
+
+def get_backoff():
+    """Seconds to wait before the first retry; the wait doubles with every attempt."""
+    return int(os.environ.get("MAILADM_OUTBOX_BACKOFF", 30))
+
+
+def get_max_backoff():
+    return int(os.environ.get("MAILADM_OUTBOX_MAX_BACKOFF", 3600))
+
+
+def get_max_attempts():
+    return int(os.environ.get("MAILADM_OUTBOX_MAX_ATTEMPTS", 10))
+
+
+def get_retry_delay(attempts):
+    """How many seconds to wait after the given number of failed attempts."""
+    return min(get_backoff() * 2 ** (attempts - 1), get_max_backoff())
+
+
+def process_outbox(db, addrs=None, limit=100):
+    """Carry out outbox entries in mailcow.
+
+    :param addrs: process the entries of these addresses, due or not; by default, the
+        due entries are processed, the most overdue first
+    :param limit: how many due entries to process at most
+    :return: a dict mapping the address of each entry which failed to its error
+    """
+    now = int(time.time())
+    with db.read_connection() as conn:
+        if addrs is None:
+            entries = conn.get_due_outbox(now, limit=limit)
+        else:
+            entries = conn.get_outbox(addrs)
+        if not entries:
+            return {}
+        mailcow = conn.get_mailcow_connection()
+
+    failed = {}
+    deletes = [entry.addr for entry in entries if entry.action == "delete"]
+    if deletes:
+        try:
+            failed.update(mailcow.del_users_mailcow(deletes))
+        except (MailcowError, RequestException) as e:
+            failed.update((addr, e) for addr in deletes)
+    creates = [entry for entry in entries if entry.action == "create"]
+    for entry in creates:
+        try:
+            # don't delete a mailbox which was created by someone else
+            mcuser = mailcow.get_user(entry.addr)
+            if mcuser is not None and mcuser.token == entry.token_name:
+                failed.update(mailcow.del_users_mailcow([entry.addr]))
+        except (MailcowError, RequestException) as e:
+            failed[entry.addr] = e
+
+    def finalize(conn):
+        done = [entry.addr for entry in entries if entry.addr not in failed]
+        for entry in creates:
+            if entry.addr not in failed:
+                conn.release_email_account(entry.addr)
+        conn.del_outbox(done)
+        conn.del_mailboxes_mirror(done)
+        for entry in entries:
+            if entry.addr in failed:
+                attempts = entry.attempts + 1
+                conn.retry_outbox(entry.addr, failed[entry.addr],
+                                  next_attempt=now + get_retry_delay(attempts),
+                                  dead=attempts >= get_max_attempts())
+    db.write(finalize)
+    for entry in entries:
+        if entry.addr in failed and entry.attempts + 1 >= get_max_attempts():
+            print("giving up to %s mailbox %s: %s" % (entry.action, entry.addr,
+                  failed[entry.addr]), file=sys.stderr)
+    return failed
+
+
+def get_next_delay(db, maxdelay):
+    """Return how many seconds the outbox worker can sleep, at most maxdelay."""
+    with db.read_connection() as conn:
+        next_attempt = conn.get_next_outbox_attempt()
+    if next_attempt is None:
+        return maxdelay
+    return max(0, min(next_attempt - time.time(), maxdelay))
@@ -0,0 +1,75 @@
+"""
+pre-create inactive mailboxes for each token, so signups only need to activate one.
+
+The pool is disabled unless the MAILADM_POOL_MAX environment variable is set.
+"""
+import os
+import sys
+import time
+
+import mailadm.util
+from mailadm.conn import DBError, PENDING_TTL
+from mailadm.mailcow import MailcowError
+from requests.exceptions import RequestException
+
+
+def get_pool_max():
+    """The maximum number of pre-created accounts per token; 0 disables the pool."""
+    return int(os.environ.get("MAILADM_POOL_MAX", 0))
+
+
+def get_pool_min():
+    return int(os.environ.get("MAILADM_POOL_MIN", 1))
+
+
+def get_pool_window():
+    """The pool of a token covers as many signups as it had in this many seconds."""
+    return int(os.environ.get("MAILADM_POOL_WINDOW", 600))
+
+
+def fill_pool(db):
+    """Clean up stale pool accounts and create new ones until each pool has its target size.
+
+    :return: the number of pool accounts which were created
+    """
+    now = int(time.time())
+    with db.write_transaction() as conn:
+        stale = conn.get_stale_pool_addrs(created_before=now - PENDING_TTL)
+        mailcow = conn.get_mailcow_connection()
+        missing = []
+        for name in conn.get_token_list():
+            token_info = conn.get_tokeninfo_by_name(name)
+            target = conn.get_pool_target(token_info, since=now - get_pool_window(),
+                                          minsize=get_pool_min(), maxsize=get_pool_max())
+            missing.append((token_info, target - len(conn.get_pool_addrs(name))))
+
+    if stale:
+        failed = mailcow.del_users_mailcow(stale)
+        with db.write_transaction() as conn:
+            deleted = [addr for addr in stale if addr not in failed]
+            conn.del_pool_accounts(deleted)
+            conn.del_mailboxes_mirror(deleted)
+
+    created = 0
+    for token_info, num in missing:
+        for i in range(num):
+            # a throwaway password, activating the mailbox sets a new one
+            password = mailadm.util.gen_password()
+            try:
+                with db.write_transaction() as conn:
+                    addr = conn.add_pool_account(token_info)
+            except DBError:
+                continue  # random address collision, try the next one
+            try:
+                mailcow.add_user_mailcow(addr, password, token_info.name, active=False)
+            except (MailcowError, RequestException) as e:
+                with db.write_transaction() as conn:
+                    conn.del_pool_accounts([addr])
+                print("failed to create pool account for token %s: %s" % (token_info.name, e),
+                      file=sys.stderr)
+                break
+            with db.write_transaction() as conn:
+                conn.set_pool_account_ready(addr)
+                conn.add_mailbox_mirror(addr, token_info.name)
+            created += 1
+    return created
@@ -0,0 +1,108 @@
+"""
+limit how many signups a token or a client IP address can start per minute.
+
+Each limit is a token bucket which holds a minute's worth of signups, at least one, and
+refills continuously. No limits apply by default. The buckets live in a small sqlite
+database of their own, so all gunicorn workers share them without competing with signups
+for the lock of mailadm.db. Losing it only resets the limits, so it is never synced to
+disk.
+"""
+import contextlib
+import os
+import random
+import sqlite3
+import time
+from pathlib import Path
+
+
+def get_token_rate():
+    """How many signups per minute a token allows, unless set with mod-token --rate.
+
+    0, the default, means no limit.
+    """
+    return float(os.environ.get("MAILADM_TOKEN_RATE", 0))
+
+
+def get_ip_rate():
+    """How many signups per minute a client IP address may start; 0, the default, means no
+    limit. Behind a reverse proxy, it needs MAILADM_PROXY_COUNT to tell the clients apart.
+    """
+    return float(os.environ.get("MAILADM_IP_RATE", 0))
+
+
+def get_proxy_count():
+    """How many reverse proxies in front of mailadm set X-Forwarded-For."""
+    return int(os.environ.get("MAILADM_PROXY_COUNT", 0))
+
+
+def get_ratelimit_db_path(db_path):
+    """Return the path of the bucket database, next to mailadm.db by default."""
+    path = os.environ.get("MAILADM_RATELIMIT_DB")
+    if path:
+        return Path(path)
+    db_path = Path(db_path)
+    return db_path.with_name(db_path.stem + "-ratelimit.db")
+
+
+class RateLimiter:
+    """Token buckets, shared by all processes which use the same path.
+
+    :param path: path of the sqlite database which stores the buckets
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA synchronous = OFF")
+        return contextlib.closing(conn)
+
+    def acquire(self, limits, now=None):
+        """Take one signup from each bucket, or from none of them.
+
+        :param limits: a list of (key, rate) tuples, with rate in signups per minute; a
+            rate of 0 means no limit
+        :return: 0 if the signup may proceed, otherwise after how many seconds the
+            emptiest bucket has a signup again
+        """
+        limits = [(key, rate) for key, rate in limits if rate > 0]
+        if not limits:
+            return 0
+        if now is None:
+            now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                buckets = []
+                wait = 0
+                for key, rate in limits:
+                    row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?",
+                                       (key,)).fetchone()
+                    size = max(rate, 1)
+                    tokens = size if row is None else \
+                        min(size, row[0] + (now - row[1]) * rate / 60)
+                    if tokens < 1:
+                        wait = max(wait, (1 - tokens) * 60 / rate)
+                    buckets.append((key, tokens))
+                if not wait:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                        [(key, tokens - 1, now) for key, tokens in buckets])
+                    # a bucket which wasn't touched for an hour is full again
+                    if random.random() < 0.01:
+                        conn.execute("DELETE FROM buckets WHERE updated < ?", (now - 3600,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return wait
@@ -0,0 +1,162 @@
+"""
+decide whether and when a failed account creation is tried again.
+
+Errors are classified as
+
+- collisions: the random address is taken already; trying again right away with a new
+  random address fixes it,
+- transient: mailcow or the database are overloaded or unreachable; trying again after
+  an exponential backoff with jitter may help,
+- permanent: everything else, e.g. an exhausted token; trying again can't help.
+
+All retries of a process draw from a common budget, so a struggling mailcow doesn't get
+even more requests from retries.
+"""
+import collections
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import mailadm.metrics
+from mailadm.conn import DBError, TokenExhausted
+from mailadm.mailcow import MailcowError, MailcowUnavailable
+from requests.exceptions import RequestException
+
+
+def get_backoff():
+    """Seconds to wait before the first retry of a transient error."""
+    return float(os.environ.get("MAILADM_RETRY_BACKOFF", 0.1))
+
+
+def get_max_backoff():
+    return float(os.environ.get("MAILADM_RETRY_MAX_BACKOFF", 2))
+
+
+def get_budget():
+    """How many retries a process may do per MAILADM_RETRY_WINDOW seconds."""
+    return int(os.environ.get("MAILADM_RETRY_BUDGET", 100))
+
+
+def get_window():
+    return float(os.environ.get("MAILADM_RETRY_WINDOW", 60))
+
+
+COLLISION = "collision"
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+
+
+def classify(exc):
+    """Return whether an exception is a COLLISION, TRANSIENT or PERMANENT error."""
+    if isinstance(exc, (TokenExhausted, MailcowUnavailable)):
+        return PERMANENT
+    if isinstance(exc, (MailcowError, DBError)):
+        msg = str(exc)
+        if "does already exist" in msg or "object_exists" in msg or \
+                "UNIQUE constraint failed" in msg or "is already taken" in msg:
+            return COLLISION
+        if "timeout while waiting for the database" in msg:
+            return TRANSIENT
+        return PERMANENT
+    if isinstance(exc, RequestException):
+        return TRANSIENT
+    if isinstance(exc, sqlite3.OperationalError) and "locked" in str(exc):
+        return TRANSIENT
+    return PERMANENT
+
+
+class RetryPolicy:
+    """Run a function and retry it according to the class of its errors.
+
+    :param backoff: seconds to wait before the first retry of a transient error; the wait
+        doubles with every retry up to max_backoff, and a random part of it is skipped
+    :param budget: how many retries all calls of this policy may do per window seconds
+    """
+
+    def __init__(self, backoff=None, max_backoff=None, budget=None, window=None):
+        self.backoff = get_backoff() if backoff is None else backoff
+        self.max_backoff = get_max_backoff() if max_backoff is None else max_backoff
+        self.budget = get_budget() if budget is None else budget
+        self.window = get_window() if window is None else window
+        #: how often errors of each class were retried, or not retried
+        self.counters = collections.Counter()
+        self._retries = collections.deque()
+        self._lock = threading.Lock()
+
+    def get_delay(self, retry):
+        """Return how long to wait before the given transient retry, with full jitter."""
+        return random.uniform(0, min(self.backoff * 2 ** retry, self.max_backoff))
+
+    def take_budget(self):
+        """Take one retry from the budget; return False if it is used up."""
+        now = time.monotonic()
+        with self._lock:
+            while self._retries and self._retries[0] < now - self.window:
+                self._retries.popleft()
+            if len(self._retries) >= self.budget:
+                return False
+            self._retries.append(now)
+            return True
+
+    def _count(self, kind, result):
+        if result == "budget_exhausted":
+            self.counters[result] += 1
+        else:
+            self.counters[kind + "_" + result] += 1
+        mailadm.metrics.retries.inc(**{"class": kind, "result": result})
+
+    def run(self, func, tries, deadline=None, collisions=True):
+        """Call func until it succeeds, and return its result.
+
+        :param tries: how often func is called at most
+        :param deadline: a mailadm.util.Deadline; transient errors aren't retried if the
+            backoff would exceed it
+        :param collisions: whether a new call can avoid a collision, e.g. because it
+            uses a new random address
+        """
+        transient = 0
+        for i in range(tries):
+            try:
+                return func()
+            except Exception as e:
+                kind = classify(e)
+                if kind == COLLISION and not collisions:
+                    kind = PERMANENT
+                if kind == PERMANENT or i + 1 >= tries:
+                    self._count(kind, "failed")
+                    raise
+                delay = 0
+                if kind == TRANSIENT:
+                    delay = self.get_delay(transient)
+                    transient += 1
+                    if deadline is not None and deadline.remaining() <= delay:
+                        self._count(kind, "failed")
+                        raise
+                if not self.take_budget():
+                    self._count(kind, "budget_exhausted")
+                    raise
+                self._count(kind, "retried")
+                if delay:
+                    time.sleep(delay)
+
+
+_policy = None
+
+
+def get_retry_policy():
+    """Return the process-wide retry policy for account creation."""
+    global _policy
+    if _policy is None:
+        _policy = RetryPolicy()
+    return _policy
+
+
+def _reset_policy():
+    global _policy
+    _policy = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_policy)
@@ -0,0 +1,144 @@
+"""
+run prune when users expire, instead of in fixed intervals.
+
+The scheduler sleeps until the next user expires. Users which are created while it
+sleeps, in any process, can't expire before the shortest token lifetime has passed, so it
+never sleeps longer than that. Only users which get a shorter lifetime, e.g. from a token
+which is added while it sleeps, are pruned up to MAILADM_PRUNE_MAX_INTERVAL seconds late.
+
+Mass expiries are spread out: outside of the configured maintenance windows, a prune run
+deletes at most MAILADM_PRUNE_PEAK_BATCH users and leaves the rest for the next window,
+and all deletions are throttled to MAILADM_PRUNE_RATE per second.
+"""
+import os
+import random
+import sys
+import time
+
+from mailadm.commands import prune
+
+
+def get_min_interval():
+    """At least this many seconds pass between two prune runs."""
+    return float(os.environ.get("MAILADM_PRUNE_MIN_INTERVAL", 10))
+
+
+def get_max_interval():
+    """At most this many seconds pass between two prune runs."""
+    return float(os.environ.get("MAILADM_PRUNE_MAX_INTERVAL", 3600))
+
+
+def get_jitter():
+    """Up to this many seconds are added to each sleep, so processes don't wake up together."""
+    return float(os.environ.get("MAILADM_PRUNE_JITTER", 5))
+
+
+def get_batch_size():
+    """How many users one prune run deletes at most."""
+    return int(os.environ.get("MAILADM_PRUNE_BATCH", 500))
+
+
+def get_peak_batch_size():
+    """How many users one prune run deletes at most outside of the maintenance windows."""
+    return int(os.environ.get("MAILADM_PRUNE_PEAK_BATCH", 50))
+
+
+def get_rate():
+    """How many users prune deletes per second at most; 0 doesn't throttle."""
+    return float(os.environ.get("MAILADM_PRUNE_RATE", 20))
+
+
+def get_windows():
+    return parse_windows(os.environ.get("MAILADM_PRUNE_WINDOWS", ""))
+
+
+def parse_windows(spec):
+    """Parse maintenance windows like "01:00-05:00,22:30-23:30" in local time.
+
+    :return: a list of (start, end) tuples in minutes after midnight; a window
+        whose end is before its start lasts over midnight.
+    """
+    windows = []
+    for window in filter(None, (x.strip() for x in spec.split(","))):
+        try:
+            start, end = [_parse_time(x) for x in window.split("-")]
+        except ValueError:
+            raise ValueError("invalid maintenance window {!r}, expected HH:MM-HH:MM"
+                             .format(window))
+        if start == end:
+            raise ValueError("empty maintenance window {!r}".format(window))
+        windows.append((start, end))
+    return windows
+
+
+def _parse_time(hhmm):
+    hours, minutes = hhmm.strip().split(":")
+    if not (0 <= int(hours) < 24 and 0 <= int(minutes) < 60):
+        raise ValueError(hhmm)
+    return int(hours) * 60 + int(minutes)
+
+
+class PruneScheduler:
+    def __init__(self, db, min_interval=None, max_interval=None, jitter=None, batch=None,
+                 peak_batch=None, rate=None, windows=None):
+        self.db = db
+        self.min_interval = get_min_interval() if min_interval is None else min_interval
+        self.max_interval = get_max_interval() if max_interval is None else max_interval
+        self.jitter = get_jitter() if jitter is None else jitter
+        self.batch = get_batch_size() if batch is None else batch
+        self.peak_batch = get_peak_batch_size() if peak_batch is None else peak_batch
+        self.rate = get_rate() if rate is None else rate
+        self.windows = get_windows() if windows is None else windows
+        self.last_run = 0
+        self.wakeup_at = None
+
+    def get_window_delay(self, now):
+        """Return how many seconds it is until a maintenance window starts, 0 if in one."""
+        if not self.windows:
+            return 0
+        t = time.localtime(now)
+        minute = t.tm_hour * 60 + t.tm_min
+        delays = []
+        for start, end in self.windows:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return 0
+            delays.append((start - minute) % (24 * 60) * 60 - t.tm_sec)
+        return min(delays)
+
+    def get_next_run(self, now):
+        """Return the unix timestamp when prune should run next."""
+        with self.db.read_connection() as conn:
+            next_expiry = conn.get_next_expiry(int(now))
+            min_ttl = conn.get_min_token_ttl()
+        candidates = [now + self.max_interval]
+        if next_expiry is not None:
+            # users are due once expires_at < sysdate
+            candidates.append(next_expiry + 1)
+        if min_ttl is not None:
+            candidates.append(now + min_ttl)
+        next_run = min(candidates)
+        if next_run <= now and self.get_window_delay(now):
+            # leave the backlog for the next maintenance window
+            next_run = now + min(self.get_window_delay(now), self.max_interval)
+        return max(next_run, self.last_run + self.min_interval)
+
+    def plan(self):
+        """Set the time of the next wakeup."""
+        now = time.time()
+        self.wakeup_at = self.get_next_run(now) + random.uniform(0, self.jitter)
+
+    def run_once(self):
+        """Prune one batch of expired users and plan the next run."""
+        self.last_run = time.time()
+        limit = self.peak_batch if self.get_window_delay(self.last_run) else self.batch
+        if limit > 0:
+            result = prune(self.db, limit=limit, rate=self.rate)
+            for logmsg in result.get("message"):
+                # the file=sys.stderr seems to be necessary so the output is shown in `docker logs`
+                print(logmsg, file=sys.stderr)
+        self.plan()
+
+    def run(self):
+        while 1:
+            self.run_once()
+            time.sleep(max(0, self.wakeup_at - time.time()))
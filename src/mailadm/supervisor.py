@@ -0,0 +1,162 @@
+"""
+run the background services of mailadm in threads and restart them when they stop.
+
+The supervisor doesn't poll the threads: each service thread reports its exit on a
+queue, and the supervisor sleeps on that queue until a service exits or a restart
+is due.
+"""
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+#: restart policies
+ALWAYS = "always"          # restart when the service returns or fails
+ON_FAILURE = "on-failure"  # restart only when the service raised an exception
+NEVER = "never"
+
+
+class Service:
+    """A background service which runs target(*args) in its own thread.
+
+    :param restart: the restart policy, ALWAYS, ON_FAILURE or NEVER.
+    :param backoff: seconds to wait before the first restart; the wait doubles with
+        every restart up to max_backoff and is reset once the service ran for
+        max_backoff seconds.
+    :param max_restarts: give up after this many consecutive restarts, None for never.
+    :param critical: exit the whole process when the supervisor gives up on the service.
+    """
+
+    def __init__(self, name, target, args=(), restart=ALWAYS, backoff=1, max_backoff=300,
+                 max_restarts=None, critical=False):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.restart = restart
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_restarts = max_restarts
+        self.critical = critical
+
+        self.state = "stopped"
+        self.restarts = 0
+        self.consecutive = 0
+        self.error = None
+        self.since = None
+        self.started = None
+        self.restart_at = None
+
+    def get_status(self):
+        return dict(state=self.state, restarts=self.restarts, error=self.error,
+                    since=self.since)
+
+    def get_delay(self):
+        return min(self.backoff * 2 ** (self.consecutive - 1), self.max_backoff)
+
+
+class Supervisor:
+    """Start services, restart them according to their policy and track their status.
+
+    :param on_status: called with the name and the status dict of a service whenever
+        its state changes.
+    """
+
+    def __init__(self, on_status=None):
+        self.services = {}
+        self.on_status = on_status
+        self._events = queue.Queue()
+        self._thread = None
+
+    def add(self, service):
+        self.services[service.name] = service
+
+    def start(self):
+        for service in self.services.values():
+            self._start_service(service)
+        self._thread = threading.Thread(target=self.run, daemon=True, name="supervisor")
+        self._thread.start()
+
+    def stop(self):
+        """Stop supervising; service threads are daemon threads and are not stopped."""
+        self._events.put(None)
+        self._thread.join()
+
+    def get_status(self):
+        return {name: service.get_status() for name, service in self.services.items()}
+
+    def run(self):
+        while 1:
+            now = time.time()
+            due = [s.restart_at for s in self.services.values() if s.restart_at is not None]
+            timeout = max(0, min(due) - now) if due else None
+            try:
+                event = self._events.get(timeout=timeout)
+            except queue.Empty:
+                event = ()
+            if event is None:
+                return
+            if event:
+                self._handle_exit(*event)
+            now = time.time()
+            for service in self.services.values():
+                if service.restart_at is not None and service.restart_at <= now:
+                    service.restart_at = None
+                    service.restarts += 1
+                    self._start_service(service)
+
+    def _start_service(self, service):
+        thread = threading.Thread(target=self._run_service, args=(service,), daemon=True,
+                                  name=service.name)
+        service.started = time.time()
+        self._set_state(service, "running")
+        thread.start()
+
+    def _run_service(self, service):
+        error = None
+        try:
+            service.target(*service.args)
+        except BaseException:
+            error = traceback.format_exc()
+        self._events.put((service.name, error))
+
+    def _handle_exit(self, name, error):
+        service = self.services[name]
+        if error is not None:
+            print("%s thread failed:\n%s" % (name, error), file=sys.stderr)
+            service.error = error.strip().splitlines()[-1]
+        else:
+            print("%s thread stopped" % (name,), file=sys.stderr)
+
+        if service.restart == NEVER or (service.restart == ON_FAILURE and error is None):
+            self._set_state(service, "stopped" if error is None else "failed")
+            self._give_up(service)
+            return
+        if time.time() - service.started >= service.max_backoff:
+            service.consecutive = 0
+        service.consecutive += 1
+        if service.max_restarts is not None and service.consecutive > service.max_restarts:
+            self._set_state(service, "failed")
+            self._give_up(service)
+            return
+        delay = service.get_delay()
+        print("restarting %s thread in %s seconds" % (name, delay), file=sys.stderr)
+        service.restart_at = time.time() + delay
+        self._set_state(service, "restarting")
+
+    def _give_up(self, service):
+        if service.critical:
+            print("%s thread is critical, killing everything now" % (service.name,),
+                  file=sys.stderr)
+            os._exit(1)
+
+    def _set_state(self, service, state):
+        service.state = state
+        service.since = int(time.time())
+        if self.on_status is not None:
+            try:
+                self.on_status(service.name, service.get_status())
+            except Exception as e:
+                print("failed to record status of %s thread: %s" % (service.name, e),
+                      file=sys.stderr)
@@ -0,0 +1,137 @@
+"""
+trace where the time of a web request goes.
+
+A sampled request gets a trace, and the code it runs records spans: the signup attempts,
+database writes and lock waits, and mailcow calls. The spans of a trace are reported in
+the Server-Timing header of the response, and appended as JSON lines to
+MAILADM_TRACE_FILE if it is set. Requests which aren't sampled, and code which runs
+outside of a request, e.g. in the group-commit writer thread, don't record spans; a span
+then costs a single context variable lookup.
+"""
+import contextlib
+import contextvars
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+_current = contextvars.ContextVar("mailadm_trace", default=None)
+_file_lock = threading.Lock()
+
+
+def get_sample_rate():
+    """Which share of the web requests is traced, between 0 and 1."""
+    return float(os.environ.get("MAILADM_TRACE_SAMPLE", 0))
+
+
+def get_trace_file():
+    """Path of the file to which traces are appended as JSON lines, or None."""
+    return os.environ.get("MAILADM_TRACE_FILE") or None
+
+
+class Trace:
+    """The spans which were recorded for one request."""
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.spans = []
+        self._stack = []
+        self.root = self.span(name)
+
+    def span(self, name, **attrs):
+        return Span(self, name, attrs)
+
+    def get_server_timing(self):
+        """Return the value of a Server-Timing header with all finished spans."""
+        entries = []
+        for finished in self.spans:
+            entry = "{};dur={:.1f}".format(finished.name, finished.duration * 1000)
+            if finished.attrs:
+                desc = " ".join("{}={}".format(k, v) for k, v in finished.attrs.items())
+                entry += ";desc=" + json.dumps(desc)
+            entries.append(entry)
+        return ", ".join(entries)
+
+    def export(self, path):
+        """Append the finished spans to a JSON lines file."""
+        lines = "".join(json.dumps(finished.as_dict()) + "\n" for finished in self.spans)
+        try:
+            with _file_lock, open(path, "a") as f:
+                f.write(lines)
+        except OSError as e:
+            print("failed to write trace to {}: {}".format(path, e), file=sys.stderr)
+
+
+class Span:
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.id = uuid.uuid4().hex[:16]
+        self.parent = None
+        self.start = None
+        self.duration = None
+        self.error = None
+
+    def __enter__(self):
+        stack = self.trace._stack
+        self.parent = stack[-1].id if stack else None
+        stack.append(self)
+        self.start = time.time()
+        self._started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.monotonic() - self._started
+        if exc_type is not None:
+            self.error = "{}: {}".format(exc_type.__name__, exc)
+        self.trace._stack.pop()
+        self.trace.spans.append(self)
+
+    def as_dict(self):
+        return dict(trace=self.trace.id, span=self.id, parent=self.parent, name=self.name,
+                    start=self.start, duration=self.duration, error=self.error, **self.attrs)
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_nospan = _NoSpan()
+
+
+def span(name, **attrs):
+    """Return a context manager which records a span in the current trace, if any."""
+    current = _current.get()
+    if current is None:
+        return _nospan
+    return current.span(name, **attrs)
+
+
+@contextlib.contextmanager
+def trace(name):
+    """Trace the with-block if it is sampled, as a root span with the given name.
+
+    :return: a context manager which yields the Trace, or None if it isn't sampled
+    """
+    rate = get_sample_rate()
+    if rate <= 0 or random.random() >= rate:
+        yield None
+        return
+    current = Trace(name)
+    token = _current.set(current)
+    try:
+        with current.root:
+            yield current
+    finally:
+        _current.reset(token)
+        path = get_trace_file()
+        if path is not None:
+            current.export(path)
@@ -1,6 +1,7 @@
 import sys
 import random
 import base64
+import time
 
 
 def gen_password():
@@ -27,3 +28,55 @@ def parse_expiry_code(code):
         return val * 24 * 60 * 60
     elif c == "h":
         return val * 60 * 60
+
+
+class PrefixTrie:
+    """Map prefixes to values and find the value of the longest prefix of a string."""
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, prefix, value):
+        node = self._root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        # None can't be a character, so it marks the end of a prefix
+        node[None] = value
+
+    def longest_prefix_value(self, s):
+        """Return the value of the longest prefix of s, or None if no prefix matches."""
+        node = self._root
+        value = node.get(None)
+        for c in s:
+            node = node.get(c)
+            if node is None:
+                break
+            value = node.get(None, value)
+        return value
+
+
+class DeadlineExceeded(Exception):
+    """The time budget of an operation ran out."""
+
+
+class Deadline:
+    """A time budget, which is handed down to every step of an operation.
+
+    :param timeout: how many seconds the operation may take
+    """
+
+    def __init__(self, timeout):
+        self.expires_at = time.monotonic() + timeout
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def get_timeout(self, maximum=None, what="operation"):
+        """Return the remaining seconds, at most maximum, for the next step.
+
+        :raises DeadlineExceeded: if no time is left
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("deadline exceeded before {}".format(what))
+        return remaining if maximum is None else min(remaining, maximum)
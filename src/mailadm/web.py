@@ -1,10 +1,74 @@
+import collections
+import math
+import os
+import threading
+import time
+
 from flask import Flask, request, jsonify
+from werkzeug.middleware.proxy_fix import ProxyFix
 import mailadm.db
-from mailadm.conn import DBError
-from mailadm.mailcow import MailcowError
+import mailadm.metrics
+import mailadm.tracing
+from mailadm.conn import DBError, TokenExhausted
+from mailadm.mailcow import MailcowError, MailcowUnavailable, get_circuit_breaker
+from mailadm.ratelimit import RateLimiter, get_ip_rate, get_proxy_count, \
+    get_ratelimit_db_path, get_token_rate
+from mailadm.util import Deadline, DeadlineExceeded
 from requests.exceptions import ReadTimeout
 
 
+def get_request_timeout():
+    """How many seconds creating an account may take at most, before 504 is returned."""
+    return float(os.environ.get("MAILADM_REQUEST_TIMEOUT", 20))
+
+
+def get_token_cache_size():
+    """How many tokens each web worker caches, including invalid ones."""
+    return int(os.environ.get("MAILADM_TOKEN_CACHE_SIZE", 1024))
+
+
+class TokenCache:
+    """LRU cache of token strings, for rejecting invalid and exhausted tokens cheaply.
+
+    Each entry maps a token string to its TokenInfo, or to None for an invalid token, and
+    remembers whether the token is known to be exhausted. Entries are only valid for the
+    generation of the tokens and config tables they were read in; add_token(), mod_token(),
+    del_token() and set_config() bump it.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, conn, token):
+        """Return a tuple of the TokenInfo (or None) and whether the token is exhausted."""
+        generation = (conn.get_generation("tokens"), conn.get_generation("config"))
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(token)
+                return entry[1], entry[2]
+        token_info = conn.get_tokeninfo_by_token(token)
+        exhausted = token_info is not None and token_info.usecount >= token_info.maxuse
+        self._put(token, generation, token_info, exhausted)
+        return token_info, exhausted
+
+    def set_exhausted(self, token):
+        """Remember that a token is exhausted until the tokens are modified."""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                self._entries[token] = (entry[0], entry[1], True)
+
+    def _put(self, token, generation, token_info, exhausted):
+        with self._lock:
+            self._entries[token] = (generation, token_info, exhausted)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
 def create_app_from_db_path(db_path=None):
     if db_path is None:
         db_path = mailadm.db.get_db_path()
@@ -16,31 +80,90 @@ def create_app_from_db_path(db_path=None):
 def create_app_from_db(db):
     app = Flask("mailadm-account-server")
     app.db = db
+    app.token_cache = TokenCache(get_token_cache_size())
+    app.rate_limiter = RateLimiter(get_ratelimit_db_path(db.path))
+    if get_proxy_count():
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=get_proxy_count())
+
+    if mailadm.metrics.get_serve_metrics():
+        mailadm.metrics.enable(mailadm.metrics.get_metrics_db_path(db.path))
 
     @app.route('/', methods=["POST"])
     def new_email():
+        start = time.monotonic()
+        with mailadm.tracing.trace("new_email") as trace:
+            response = app.make_response(create_email())
+        mailadm.metrics.signup_seconds.observe(time.monotonic() - start,
+                                               status=response.status_code)
+        if trace is not None:
+            response.headers["Server-Timing"] = trace.get_server_timing()
+        return response
+
+    def create_email():
         token = request.args.get("t")
         if token is None:
             return jsonify(type="error", status_code=403,
                            reason="?t (token) parameter not specified"), 403
 
-        with db.write_transaction() as conn:
-            token_info = conn.get_tokeninfo_by_token(token)
-            if token_info is None:
-                return jsonify(type="error", status_code=403,
-                               reason="token {} is invalid".format(token)), 403
-            try:
-                user_info = conn.add_email_account_tries(token_info, tries=10)
-                return jsonify(email=user_info.addr, password=user_info.password,
-                               expiry=token_info.expiry, ttl=user_info.ttl)
-            except (DBError, MailcowError) as e:
-                if "does already exist" in str(e):
-                    return jsonify(type="error", status_code=409,
-                                   reason="user already exists in mailcow"), 409
-                if "UNIQUE constraint failed" in str(e):
-                    return jsonify(type="error", status_code=409,
-                                   reason="user already exists in mailadm"), 409
-                return jsonify(type="error", status_code=500, reason=str(e)), 500
-            except ReadTimeout:
-                return jsonify(type="error", status_code=504, reason="mailcow not reachable"), 504
+        with db.read_connection() as conn:
+            token_info, exhausted = app.token_cache.lookup(conn, token)
+        limits = [("ip:" + str(request.remote_addr), get_ip_rate())]
+        if token_info is not None:
+            rate = token_info.rate if token_info.rate is not None else get_token_rate()
+            limits.append(("token:" + token_info.name, rate))
+        with mailadm.tracing.span("ratelimit"):
+            wait = app.rate_limiter.acquire(limits)
+        if wait:
+            return jsonify(type="error", status_code=429, reason="too many signups"), \
+                429, {"Retry-After": str(math.ceil(wait))}
+        if token_info is None:
+            return jsonify(type="error", status_code=403,
+                           reason="token {} is invalid".format(token)), 403
+        if exhausted:
+            return jsonify(type="error", status_code=410,
+                           reason="token {} is exhausted".format(token)), 410
+        try:
+            deadline = Deadline(get_request_timeout())
+            user_info = db.add_email_account_tries(token_info, tries=10, deadline=deadline)
+            return jsonify(email=user_info.addr, password=user_info.password,
+                           expiry=token_info.expiry, ttl=user_info.ttl)
+        except TokenExhausted:
+            app.token_cache.set_exhausted(token)
+            return jsonify(type="error", status_code=410,
+                           reason="token {} is exhausted".format(token)), 410
+        except MailcowUnavailable as e:
+            return jsonify(type="error", status_code=503, reason="mailcow not available"), \
+                503, {"Retry-After": str(math.ceil(e.retry_after))}
+        except (DBError, MailcowError) as e:
+            if "does already exist" in str(e):
+                return jsonify(type="error", status_code=409,
+                               reason="user already exists in mailcow"), 409
+            if "UNIQUE constraint failed" in str(e):
+                return jsonify(type="error", status_code=409,
+                               reason="user already exists in mailadm"), 409
+            return jsonify(type="error", status_code=500, reason=str(e)), 500
+        except ReadTimeout:
+            return jsonify(type="error", status_code=504, reason="mailcow not reachable"), 504
+        except DeadlineExceeded as e:
+            return jsonify(type="error", status_code=504, reason=str(e)), 504
+
+    @app.route('/metrics', methods=["GET"])
+    def metrics():
+        if not mailadm.metrics.get_serve_metrics():
+            return jsonify(type="error", status_code=404, reason="metrics are disabled"), 404
+        return mailadm.metrics.render(db), 200, \
+            {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+    @app.route('/health', methods=["GET"])
+    def health():
+        with db.read_connection() as conn:
+            services = conn.get_service_statuses()
+        failing = [name for name, status in services.items()
+                   if status["state"] not in ("running", "stopped")]
+        # the circuit breaker of this worker process
+        mailcow = get_circuit_breaker(db.get_config().mailcow_endpoint).state
+        if failing:
+            return jsonify(status="degraded", failing=failing, services=services,
+                           mailcow=mailcow), 503
+        return jsonify(status="ok", services=services, mailcow=mailcow)
     return app
@@ -13,6 +13,8 @@ from _pytest.pytester import LineMatcher
 
 import mailadm.db
 import mailadm.bot
+import mailadm.mailcow
+import mailadm.metrics
 
 
 @pytest.fixture(autouse=True)
@@ -24,6 +26,10 @@ def _nocfg(monkeypatch, tmpdir):
         raise KeyError(name)
 
     monkeypatch.setattr(pwd, "getpwnam", getpwnam)
+    # don't let mailcow failures of one test open the circuit breaker for the next ones
+    mailadm.mailcow._breakers.clear()
+    # web apps enable the metrics for the whole process
+    monkeypatch.setattr(mailadm.metrics, "_store", None)
 
 
 class ClickRunner:
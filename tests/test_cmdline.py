@@ -40,6 +40,27 @@ class TestConfig:
         """)
 
 
+def test_migrate_db_current_version(mycmd):
+    mycmd.run_ok(["add-token", "oneweek", "--token=1w_Zeeg1RSOK4e3Nh0V", "--rate", "5"])
+    mycmd.run_ok(["migrate-db"])
+    with mycmd.db.read_connection() as conn:
+        assert conn.get_dbversion() == mycmd.db.CURRENT_DBVERSION
+        assert conn.get_tokeninfo_by_name("oneweek").rate == 5
+
+
+def test_migrate_db_keeps_pending_users(mycmd):
+    mycmd.run_ok(["add-token", "oneweek", "--token=1w_Zeeg1RSOK4e3Nh0V"])
+    with mycmd.db.write_transaction() as conn:
+        token_info = conn.get_tokeninfo_by_name("oneweek")
+        conn.reserve_email_account(token_info, addr="tmp.1@x.testrun.org")
+        conn.execute("UPDATE users SET prune_claim = 1000")
+        before = conn.execute("SELECT pending, prune_claim, expires_at FROM users").fetchall()
+    mycmd.run_ok(["migrate-db"])
+    with mycmd.db.read_connection() as conn:
+        assert conn.execute("SELECT pending, prune_claim, expires_at FROM users").fetchall() \
+            == before == [(1, 1000, before[0][2])]
+
+
 class TestQR:
     def test_gen_qr(self, mycmd, tmpdir, monkeypatch):
         mycmd.run_ok(["add-token", "oneweek", "--token=1w_Zeeg1RSOK4e3Nh0V",
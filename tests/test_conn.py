@@ -3,8 +3,9 @@ from random import randint
 import requests
 
 import mailadm
-from mailadm.conn import DBError
-from mailadm.mailcow import MailcowError
+from mailadm.commands import prune
+from mailadm.conn import DBError, TokenExhausted
+from mailadm.mailcow import MailcowConnection, MailcowError, MailcowUser
 
 
 @pytest.fixture
@@ -33,15 +34,16 @@ def test_token_info(conn):
     assert not conn.get_tokeninfo_by_name("burner2")
 
 
-def test_email_tmp_gen(conn, mailcow):
-    conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3", prefix="tmp.")
-    token_info = conn.get_tokeninfo_by_name("burner1")
-    user_info = conn.add_email_account(token_info=token_info)
+def test_email_tmp_gen(db, mailcow):
+    with db.write_transaction() as conn:
+        conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3", prefix="tmp.")
+        token_info = conn.get_tokeninfo_by_name("burner1")
+    user_info = db.add_email_account_tries(token_info=token_info)
 
     assert user_info.token_name == "burner1"
     localpart, domain = user_info.addr.split("@")
     assert localpart.startswith("tmp.")
-    assert domain == conn.config.mail_domain
+    assert domain == db.get_config().mail_domain
 
     username = localpart[4:]
     assert len(username) == 5
@@ -59,18 +61,20 @@ def test_adduser_mailcow_error(db):
 
     with db.write_transaction() as conn:
         conn.set_config("mailcow_token", "wrong")
-        with pytest.raises(MailcowError):
-            conn.add_email_account(token_info)
+    with pytest.raises(MailcowError):
+        db.add_email_account_tries(token_info)
 
     with db.write_transaction() as conn:
         token_info = conn.get_tokeninfo_by_name(token_info.name)
-        token_info.check_exhausted()
+        assert token_info.usecount == 0
         assert conn.get_user_list(token=token_info.name) == []
 
 
-def test_adduser_db_error(conn, monkeypatch):
+def test_adduser_db_error(db, monkeypatch):
     """Test that no mailcow user is created if there is a DB error"""
-    token_info = conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3", prefix="tmp.")
+    with db.write_transaction() as conn:
+        token_info = conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3",
+                                    prefix="tmp.")
     addr = "pytest.%s@x.testrun.org" % (randint(0, 999),)
 
     def add_user_db(*args, **kwargs):
@@ -78,10 +82,11 @@ def test_adduser_db_error(conn, monkeypatch):
     monkeypatch.setattr(mailadm.conn.Connection, "add_user_db", add_user_db)
 
     with pytest.raises(DBError):
-        conn.add_email_account(token_info, addr=addr)
+        db.add_email_account_tries(token_info, addr=addr)
 
-    url = "%sget/mailbox/%s" % (conn.config.mailcow_endpoint, addr)
-    auth = {"X-API-Key": conn.config.mailcow_token}
+    config = db.get_config()
+    url = "%sget/mailbox/%s" % (config.mailcow_endpoint, addr)
+    auth = {"X-API-Key": config.mailcow_token}
     result = requests.get(url, headers=auth)
     assert result.status_code == 200
     if result.json() is not {} and type(result.json()) == list:
@@ -89,30 +94,203 @@ def test_adduser_db_error(conn, monkeypatch):
             assert user["username"] != addr
 
 
-def test_adduser_mailcow_exists(conn, mailcow):
+def test_adduser_mailcow_exists(db, mailcow):
     """Test that no user is created if Mailcow user already exists"""
-    token_info = conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3", prefix="tmp.")
+    with db.write_transaction() as conn:
+        token_info = conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3",
+                                    prefix="tmp.")
     addr = "pytest.%s@x.testrun.org" % (randint(0, 999),)
 
     mailcow.add_user_mailcow(addr, "asdf1234", token_info.name)
     with pytest.raises(MailcowError):
-        conn.add_email_account(token_info, addr=addr)
-    for user in conn.get_user_list():
-        assert user.token_name == "created in mailcow"
+        db.add_email_account_tries(token_info, addr=addr)
+    with db.read_connection() as conn:
+        for user in conn.get_user_list():
+            assert user.token_name == "created in mailcow"
 
     mailcow.del_user_mailcow(addr)
 
 
-def test_delete_user_mailcow_missing(conn, mailcow):
+def test_delete_user_mailcow_missing(db, mailcow):
     """Test if a mailadm user is deleted successfully if mailcow user is already missing"""
-    token_info = conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3", prefix="tmp.")
+    with db.write_transaction() as conn:
+        token_info = conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3",
+                                    prefix="tmp.")
     addr = "pytest.%s@x.testrun.org" % (randint(0, 999),)
 
-    conn.add_email_account(token_info, addr=addr)
+    db.add_email_account_tries(token_info, addr=addr)
     mailcow.del_user_mailcow(addr)
-    conn.delete_email_account(addr)
+    with db.write_transaction() as conn:
+        conn.delete_email_account(addr)
 
 
 def test_db_version(conn):
     version = conn.get_dbversion()
     assert type(version) == int
+
+
+def test_prune_batched(db, mailcow):
+    with db.write_transaction() as conn:
+        token_info = conn.add_token("burner1", expiry="1h", token="1h_7wDioPeeXyZx96v3",
+                                    prefix="tmp.")
+    addrs = [db.add_email_account_tries(token_info).addr for i in range(3)]
+    with db.write_transaction() as conn:
+        conn.execute("UPDATE users SET date = date - 7200, expires_at = expires_at - 7200")
+
+    result = prune(db, chunksize=2)
+    assert result["status"] == "success"
+    assert len(result["message"]) == 3
+    with db.read_connection() as conn:
+        assert conn.get_user_list(token="burner1") == []
+    for addr in addrs:
+        assert mailcow.get_user(addr) is None
+
+
+def test_add_email_account_releases_lock(db, monkeypatch):
+    """Test that mailcow is called without holding the database lock"""
+    with db.write_transaction() as conn:
+        token_info = conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3",
+                                    prefix="tmp.", maxuse=1)
+
+    def add_user_mailcow(self, addr, password, token, quota=0):
+        with db.write_transaction() as conn:
+            assert conn.get_tokeninfo_by_name("burner1").usecount == 1
+            assert conn.get_user_by_addr(addr).token_name == "burner1"
+
+    monkeypatch.setattr(MailcowConnection, "get_user", lambda self, addr: None)
+    monkeypatch.setattr(MailcowConnection, "add_user_mailcow", add_user_mailcow)
+    user_info = db.add_email_account_tries(token_info)
+    assert user_info.password
+    assert user_info.ttl == 7 * 24 * 60 * 60
+    with pytest.raises(TokenExhausted):
+        db.add_email_account_tries(token_info, tries=3)
+
+
+def test_add_email_account_rollback(db, monkeypatch):
+    """Test that the reservation is released if mailcow fails"""
+    with db.write_transaction() as conn:
+        token_info = conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3",
+                                    prefix="tmp.", maxuse=1)
+
+    def add_user_mailcow(self, addr, password, token, quota=0):
+        raise MailcowError("mailcow is down")
+
+    monkeypatch.setattr(MailcowConnection, "get_user", lambda self, addr: None)
+    monkeypatch.setattr(MailcowConnection, "add_user_mailcow", add_user_mailcow)
+    with pytest.raises(MailcowError):
+        db.add_email_account_tries(token_info, tries=2)
+    with db.read_connection() as conn:
+        assert conn.get_tokeninfo_by_name("burner1").usecount == 0
+        assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+
+
+def test_reserve_token_use(db):
+    with db.write_transaction() as conn:
+        token_info = conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3",
+                                    prefix="tmp.", maxuse=2)
+    # token_info still says usecount == 0, the UPDATE decides
+    with db.write_transaction() as conn:
+        conn.reserve_email_account(token_info, addr="tmp.a@x.testrun.org")
+        with pytest.raises(DBError, match="UNIQUE"):
+            conn.reserve_email_account(token_info, addr="tmp.a@x.testrun.org")
+        conn.reserve_email_account(token_info, addr="tmp.b@x.testrun.org")
+    with db.write_transaction() as conn:
+        with pytest.raises(TokenExhausted):
+            conn.reserve_email_account(token_info, addr="tmp.c@x.testrun.org")
+        with pytest.raises(DBError, match="does not exist"):
+            conn.reserve_token_use("burner2")
+        conn.release_email_account("tmp.a@x.testrun.org")
+        conn.release_email_account("tmp.b@x.testrun.org")
+        conn.release_token_use("burner1")
+        assert conn.get_tokeninfo_by_name("burner1").usecount == 0
+
+
+def test_reserve_taken_addr(db):
+    with db.write_transaction() as conn:
+        token_info = conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3",
+                                    prefix="tmp.")
+        conn.add_user_db("tmp.a@x.testrun.org", 1000, 60, "burner1")
+        conn.reserve_email_account(token_info, addr="tmp.b@x.testrun.org")
+    with db.write_transaction() as conn:
+        # a confirmed user has a mailbox, a pending one may still fail to get it
+        with pytest.raises(MailcowError, match="does already exist"):
+            conn.reserve_email_account(token_info, addr="tmp.a@x.testrun.org")
+        with pytest.raises(DBError, match="UNIQUE"):
+            conn.reserve_email_account(token_info, addr="tmp.b@x.testrun.org")
+
+
+def test_tokeninfo_by_addr_longest_prefix(db):
+    with db.write_transaction() as conn:
+        conn.add_token("short", expiry="1w", token="1w_7wDioPeeXyZx96v3", prefix="tmp.")
+        conn.add_token("long", expiry="1w", token="1w_7wDioPeeXyZx96v4", prefix="tmp.event.")
+    with db.read_connection() as conn:
+        assert conn.get_tokeninfo_by_addr("tmp.event.xyz@x.testrun.org").name == "long"
+        assert conn.get_tokeninfo_by_addr("tmp.xyz@x.testrun.org").name == "short"
+        assert conn.get_tokeninfo_by_addr("xyz@x.testrun.org") is None
+
+    with db.write_transaction() as conn:
+        conn.del_token("long")
+    with db.read_connection() as conn:
+        assert conn.get_tokeninfo_by_addr("tmp.event.xyz@x.testrun.org").name == "short"
+
+
+def test_config_cache(db):
+    with db.read_connection() as conn:
+        config = conn.config
+        assert conn.config is config
+    with db.write_transaction() as conn:
+        conn.set_config("web_endpoint", "https://example.org/other")
+        # a write connection sees its own uncommitted changes
+        assert conn.config.web_endpoint == "https://example.org/other"
+    assert db.get_config().web_endpoint == "https://example.org/other"
+    assert db.get_config() is db.get_config()
+
+
+def test_user_list_reconciliation(db, monkeypatch):
+    with db.write_transaction() as conn:
+        conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3", prefix="tmp.")
+        conn.add_token("burner2", expiry="1w", token="1w_7wDioPeeXyZx96v4", prefix="tmp.")
+        conn.add_user_db("tmp.a@x.testrun.org", 1000, 60, "burner1")
+        conn.add_user_db("tmp.b@x.testrun.org", 1000, 60, "burner1")
+        conn.add_user_db("tmp.c@x.testrun.org", 1000, 60, "burner2")
+
+    mcusers = [MailcowUser({"username": "tmp.a@x.testrun.org", "tags": ["mailadm:burner1"]}),
+               MailcowUser({"username": "tmp.c@x.testrun.org", "tags": ["mailadm:burner2"]}),
+               MailcowUser({"username": "admin@x.testrun.org"})]
+    monkeypatch.setattr(MailcowConnection, "get_user_list", lambda self: mcusers)
+    with db.read_connection() as conn:
+        users = [(u.addr, u.token_name) for u in conn.iter_user_list()]
+        assert users == [("tmp.a@x.testrun.org", "burner1"),
+                         ("tmp.b@x.testrun.org", "WARNING: does not exist in mailcow"),
+                         ("tmp.c@x.testrun.org", "burner2"),
+                         ("admin@x.testrun.org", "created in mailcow")]
+        users = [(u.addr, u.token_name) for u in conn.iter_user_list(token="burner2")]
+        assert users == [("tmp.c@x.testrun.org", "burner2")]
+
+
+def test_mailbox_mirror(db, monkeypatch):
+    with db.write_transaction() as conn:
+        token_info = conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3",
+                                    prefix="tmp.")
+    mcusers = [MailcowUser({"username": "tmp.a@x.testrun.org", "tags": ["mailadm:burner1"]})]
+    monkeypatch.setattr(MailcowConnection, "get_user_list", lambda self: mcusers)
+    db.refresh_mailbox_mirror()
+
+    def get_user(self, addr):
+        raise AssertionError("the mirror is fresh, mailcow should not be asked")
+
+    monkeypatch.setattr(MailcowConnection, "get_user", get_user)
+    monkeypatch.setattr(MailcowConnection, "add_user_mailcow", lambda *args: None)
+    with db.read_connection() as conn:
+        assert conn.mailbox_in_mirror("tmp.a@x.testrun.org") is True
+        assert conn.mailbox_in_mirror("tmp.b@x.testrun.org") is False
+    with pytest.raises(MailcowError):
+        db.add_email_account_tries(token_info, addr="tmp.a@x.testrun.org")
+    db.add_email_account_tries(token_info, addr="tmp.b@x.testrun.org")
+    with db.read_connection() as conn:
+        assert conn.mailbox_in_mirror("tmp.b@x.testrun.org") is True
+        assert [u.token_name for u in conn.get_user_list()] == ["burner1", "created in mailcow"]
+
+    monkeypatch.setenv("MAILCOW_MIRROR_MAXAGE", "0")
+    with db.read_connection() as conn:
+        assert conn.mailbox_in_mirror("tmp.a@x.testrun.org") is None
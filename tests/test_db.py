@@ -1,9 +1,18 @@
 
 
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
 import pytest
+from requests.exceptions import ReadTimeout
 
+import mailadm.db
 from mailadm.conn import DBError, TokenExhausted, UserNotFound
-from mailadm.util import gen_password
+from mailadm.db import DB, FifoLock
+from mailadm.util import gen_password, Deadline, DeadlineExceeded
 
 
 def test_token(tmpdir, make_db):
@@ -35,8 +44,11 @@ class TestTokenAccounts:
     MAXUSE = 10
 
     @pytest.fixture
-    def conn(self, tmpdir, make_db):
-        db = make_db(tmpdir.mkdir("conn"))
+    def db(self, tmpdir, make_db):
+        return make_db(tmpdir.mkdir("conn"))
+
+    @pytest.fixture
+    def conn(self, db):
         conn = db.get_connection(write=True)
         conn.add_token(name="onehour", prefix="xyz", expiry="1h",
                        maxuse=self.MAXUSE, token="123456789012345")
@@ -49,16 +61,19 @@ class TestTokenAccounts:
         with pytest.raises(DBError):
             conn.add_user_db(addr=addr, date=now, ttl=60 * 60, token_name="112l3kj123123")
 
-    def test_add_maxuse(self, conn):
+    def test_add_maxuse(self, db, conn):
         now = 10000
         password = gen_password()
         for i in range(self.MAXUSE):
             addr = "tmp.{}@x.testrun.org".format(i)
             conn.add_user_db(addr=addr, date=now, ttl=60 * 60, token_name="onehour")
-
         token_info = conn.get_tokeninfo_by_name("onehour")
+        conn.commit()
+        conn.close()
+
         with pytest.raises(TokenExhausted):
-            conn.add_email_account(token_info, addr="tmp.xx@x.testrun.org", password=password)
+            db.add_email_account_tries(token_info, addr="tmp.xx@x.testrun.org",
+                                       password=password)
 
     def test_add_expire_del(self, conn):
         now = 10000
@@ -85,3 +100,220 @@ class TestTokenAccounts:
         with pytest.raises(UserNotFound):
             conn.del_user_db(addr2)
         assert conn.get_tokeninfo_by_name("onehour").usecount == 3
+
+    def test_claim_expired_users(self, conn):
+        now = 10000
+        conn.add_user_db(addr="tmp.1@x.testrun.org", date=now, ttl=60, token_name="onehour")
+        conn.add_user_db(addr="tmp.2@x.testrun.org", date=now, ttl=60, token_name="onehour")
+        conn.add_user_db(addr="tmp.3@x.testrun.org", date=now, ttl=600, token_name="onehour")
+        claimed = conn.claim_expired_users(sysdate=now + 120)
+        assert sorted(u.addr for u in claimed) == ["tmp.1@x.testrun.org", "tmp.2@x.testrun.org"]
+        assert conn.claim_expired_users(sysdate=now + 180) == []
+
+        # stale claims of crashed prune runs are taken over
+        claimed = conn.claim_expired_users(sysdate=now + 120 + 3600 + 1)
+        assert sorted(u.addr for u in claimed) == \
+            ["tmp.1@x.testrun.org", "tmp.2@x.testrun.org", "tmp.3@x.testrun.org"]
+
+    def test_next_expiry(self, conn):
+        now = 10000
+        assert conn.get_next_expiry(now) is None
+        assert conn.get_min_token_ttl() == 3600
+        conn.add_user_db(addr="tmp.1@x.testrun.org", date=now, ttl=60, token_name="onehour")
+        conn.add_user_db(addr="tmp.2@x.testrun.org", date=now, ttl=600, token_name="onehour")
+        assert conn.get_next_expiry(now) == now + 60
+        conn.claim_expired_users(sysdate=now + 120)
+        assert conn.get_next_expiry(now + 120) == now + 600
+        # the claim becomes stale before tmp.2 expires
+        assert conn.get_next_expiry(now + 120, claim_timeout=100) == now + 220
+
+    def test_min_token_ttl(self, conn):
+        conn.add_token(name="forever", prefix="abc", expiry="never", token="1234567890abcd")
+        conn.add_token(name="oneday", prefix="abc", expiry="1d", token="1234567890abce")
+        queries = []
+        conn._sqlconn.set_trace_callback(queries.append)
+        assert conn.get_min_token_ttl() == 3600
+        conn._sqlconn.set_trace_callback(None)
+        assert len(queries) == 1
+
+    def test_expired_users_limit(self, conn):
+        now = 10000
+        for i, ttl in enumerate([300, 100, 200, sys.maxsize]):
+            conn.add_user_db(addr="tmp.{}@x.testrun.org".format(i), date=now, ttl=ttl,
+                             token_name="onehour")
+        expired = conn.get_expired_users(sysdate=now + 1000, limit=2)
+        assert [u.addr for u in expired] == ["tmp.1@x.testrun.org", "tmp.2@x.testrun.org"]
+        assert len(conn.get_expired_users(sysdate=now + 1000)) == 3
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT addr FROM users WHERE expires_at < ?",
+                            (now,)).fetchall()
+        assert "users_expires_at" in str(plan)
+
+
+def test_migrate_expires_at(tmpdir):
+    path = Path(str(tmpdir)).joinpath("mailadm.db")
+    sqlconn = sqlite3.connect(str(path))
+    sqlconn.executescript("""
+        CREATE TABLE tokens (name TEXT PRIMARY KEY, token TEXT NOT NULL UNIQUE,
+                             expiry TEXT NOT NULL, prefix TEXT, maxuse INTEGER default 50,
+                             usecount INTEGER default 0);
+        CREATE TABLE users (addr TEXT PRIMARY KEY, date INTEGER, ttl INTEGER,
+                            token_name TEXT NOT NULL,
+                            FOREIGN KEY (token_name) REFERENCES tokens (name));
+        CREATE TABLE config (name TEXT PRIMARY KEY, value TEXT);
+        INSERT INTO config VALUES ('dbversion', '1');
+        INSERT INTO tokens (name, token, expiry, prefix) VALUES ('t', '123', '1h', 'tmp.');
+    """)
+    sqlconn.execute("INSERT INTO users VALUES ('tmp.1@x.testrun.org', 1000, 60, 't')")
+    sqlconn.execute("INSERT INTO users VALUES ('tmp.2@x.testrun.org', 1000, ?, 't')",
+                    (sys.maxsize,))
+    sqlconn.commit()
+    sqlconn.close()
+
+    db = DB(path)
+    with db.read_connection() as conn:
+        assert conn.get_dbversion() == DB.CURRENT_DBVERSION
+        assert [u.addr for u in conn.get_expired_users(sysdate=2000)] == ["tmp.1@x.testrun.org"]
+
+
+def test_fifo_lock_order():
+    lock = FifoLock()
+    lock.acquire()
+    order = []
+    threads = []
+    for i in range(5):
+        def acquire(i=i):
+            lock.acquire()
+            order.append(i)
+            lock.release()
+        t = threading.Thread(target=acquire)
+        t.start()
+        threads.append(t)
+        while lock._next_ticket < i + 2:
+            time.sleep(0.001)
+    assert not lock.acquire(timeout=0.01)  # an abandoned ticket is skipped
+    lock.release()
+    for t in threads:
+        t.join()
+    assert order == [0, 1, 2, 3, 4]
+
+
+def test_group_commit(tmpdir):
+    db = DB(Path(str(tmpdir)).joinpath("mailadm.db"))
+    db.init_config("x.testrun.org", "https://example.org/new_email",
+                   "https://mailcow.example.org/api/v1/", "token")
+
+    def add_token(name):
+        def job(conn):
+            return conn.add_token(name=name, token=name, expiry="1d", prefix="tmp.").name
+        return job
+
+    futures = [db.writer.submit(add_token(name)) for name in ["a", "b", "a", "c"]]
+    assert [f.result() for f in futures if not f.exception()] == ["a", "b", "c"]
+    assert isinstance(futures[2].exception(), DBError)
+    assert db.write(lambda conn: sorted(conn.get_token_list())) == ["a", "b", "c"]
+
+    with db.write_transaction():
+        with pytest.raises(RuntimeError):
+            db.write(lambda conn: None)
+
+
+def test_connection_pool_and_hooks(tmpdir, monkeypatch):
+    db = DB(Path(str(tmpdir)).joinpath("mailadm.db"))
+    db.init_config("x.testrun.org", "https://example.org/new_email",
+                   "https://mailcow.example.org/api/v1/", "token")
+    calls = []
+    monkeypatch.setattr(mailadm.db, "connection_hooks",
+                        mailadm.db.connection_hooks + [lambda c, write: calls.append(write)])
+    mailadm.db.add_connection_hook(lambda c, write: None)
+
+    for i in range(3):
+        with db.read_connection() as conn:
+            assert conn.get_token_list() == ["t%d" % (j,) for j in range(i)]
+        with db.write_transaction() as conn:
+            conn.add_token(name="t%d" % (i,), token="t%d" % (i,), expiry="1d", prefix="tmp.")
+    # each connection was set up once, and then reused
+    assert sorted(calls) == [False, True]
+
+    # foreign keys aren't enforced, a token with users can be deleted
+    with db.write_transaction() as conn:
+        conn.add_user_db("tmp.1@x.testrun.org", 1000, 60, "t0")
+        conn.del_token("t0")
+
+
+def test_sqlite_profile(tmpdir, monkeypatch):
+    def mismatches(db):
+        return [x for x in db.check_sqlite_profile() if x[1] != x[2]]
+
+    path = Path(str(tmpdir)).joinpath("mailadm.db")
+    db = DB(path)
+    db.init_config("x.testrun.org", "https://example.org/new_email",
+                   "https://mailcow.example.org/api/v1/", "token")
+    assert mismatches(db) == []
+    with db.read_connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 2
+
+    monkeypatch.setenv("MAILADM_SQLITE_PROFILE", "performance")
+    monkeypatch.setenv("MAILADM_SQLITE_CACHE_SIZE", "-4000")
+    # as if mailadm was restarted with the new settings
+    db.get_pool(write=False).clear()
+    db.get_pool(write=True).clear()
+    mailadm.db._reset_registry()
+    assert ("journal_mode", "wal", "delete") in mismatches(db)
+    db = DB(path)
+    assert mismatches(db) == []
+    with db.read_connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+        assert conn.execute("PRAGMA cache_size").fetchone()[0] == -4000
+
+    monkeypatch.setenv("MAILADM_SQLITE_PROFILE", "fastest")
+    with pytest.raises(RuntimeError):
+        mailadm.db.get_sqlite_profile()
+
+
+def test_signup_deadline(db, monkeypatch):
+    with db.write_transaction() as conn:
+        token_info = conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3",
+                                    prefix="tmp.")
+        session = conn.get_mailcow_connection().session
+
+    class Response:
+        status_code = 200
+
+        def json(self):
+            return {}
+
+    def post(url, timeout, **kwargs):
+        time.sleep(timeout)
+        raise ReadTimeout("mailcow is slow")
+
+    monkeypatch.setattr(session, "get", lambda url, **kwargs: Response())
+    monkeypatch.setattr(session, "post", post)
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        db.add_email_account_tries(token_info, tries=10, deadline=Deadline(0.2))
+    assert time.monotonic() - start < 1
+    with db.read_connection() as conn:
+        assert conn.get_tokeninfo_by_name("burner1").usecount == 0
+        [entry] = conn.get_outbox()
+    assert entry.action == "create"
+
+    # waiting for the database lock is limited by the deadline, too
+    locked = threading.Event()
+    done = threading.Event()
+
+    def hold_lock():
+        with db.write_transaction():
+            locked.set()
+            done.wait()
+
+    t = threading.Thread(target=hold_lock)
+    t.start()
+    locked.wait()
+    try:
+        with pytest.raises(DeadlineExceeded):
+            db.add_email_account_tries(token_info, deadline=Deadline(0.1))
+    finally:
+        done.set()
+        t.join()
@@ -1,7 +1,11 @@
+import time
 from random import randint
 
 import pytest
-from mailadm.mailcow import MailcowError
+from requests.exceptions import ConnectTimeout
+
+from mailadm.mailcow import CircuitBreaker, MailcowConnection, MailcowError, MailcowUnavailable, \
+    MailcowUser
 
 
 class TestMailcow:
@@ -30,3 +34,85 @@ class TestMailcow:
             mailcow.get_user(addr)
         with pytest.raises(MailcowError):
             mailcow.del_user_mailcow(addr)
+
+
+def test_session_is_shared():
+    mc1 = MailcowConnection("https://mailcow.example.org/api/v1/", "token1")
+    mc2 = MailcowConnection("https://mailcow.example.org/api/v1/", "token2")
+    assert mc1.session is mc2.session
+    other = MailcowConnection("https://other.example.org/api/v1/", "token1")
+    assert other.session is not mc1.session
+
+
+def test_del_users_mailcow_partial_failure(monkeypatch):
+    mc = MailcowConnection("https://mailcow.example.org/api/v1/", "token")
+
+    class Response:
+        status_code = 200
+
+        def json(self):
+            return [
+                {"type": "success", "msg": ["mailbox_removed", "a@x.testrun.org"]},
+                {"type": "danger", "msg": ["username_invalid", "b@x.testrun.org"]},
+            ]
+
+    class UserResponse:
+        status_code = 200
+
+        def __init__(self, url):
+            self.url = url
+
+        def json(self):
+            if self.url.endswith("c@x.testrun.org"):
+                return {}
+            return {"username": self.url.split("/")[-1]}
+
+    monkeypatch.setattr(mc.session, "post", lambda *args, **kwargs: Response())
+    monkeypatch.setattr(mc.session, "get", lambda url, **kwargs: UserResponse(url))
+    failed = mc.del_users_mailcow(["a@x.testrun.org", "b@x.testrun.org", "c@x.testrun.org"])
+    # c@ is not mentioned in the response, but it doesn't exist anymore either
+    assert failed == {"b@x.testrun.org": ["username_invalid", "b@x.testrun.org"]}
+
+
+def test_circuit_breaker(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(threshold=0.5, min_calls=4, window=60, slow=5, cooldown=30)
+
+    class Response:
+        status_code = 200
+
+    def fail():
+        raise ConnectTimeout("mailcow is down")
+
+    for i in range(2):
+        breaker.call(Response)
+    with pytest.raises(ConnectTimeout):
+        breaker.call(fail)
+    assert breaker.state == "closed"
+    Response.status_code = 502
+    breaker.call(Response)
+    assert breaker.state == "open"
+    with pytest.raises(MailcowUnavailable) as e:
+        breaker.call(Response)
+    assert e.value.retry_after == 30
+
+    # after the cooldown, a single probe is let through
+    now[0] += 30
+    breaker.before_call()
+    assert breaker.state == "half-open"
+    with pytest.raises(MailcowUnavailable):
+        breaker.check()
+    # a slow call counts as failed
+    breaker.after_call(ok=True, latency=6)
+    assert breaker.state == "open"
+    now[0] += 30
+    Response.status_code = 200
+    breaker.call(Response)
+    assert breaker.state == "closed"
+
+
+@pytest.mark.parametrize("tag,token", [("mailadm:1d", "1d"), ("mailadm:alpha", "alpha"),
+                                       ("other:x", None)])
+def test_user_token_tag(tag, token):
+    assert MailcowUser({"username": "a@x.testrun.org", "tags": [tag]}).token == token
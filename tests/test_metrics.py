@@ -0,0 +1,72 @@
+import mailadm.metrics
+from mailadm.metrics import Counter, Histogram, MetricsStore
+from mailadm.web import create_app_from_db_path
+
+
+def test_aggregate_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(mailadm.metrics, "_metrics", [])
+    hist = Histogram("test_seconds", "A test histogram", buckets=(0.1, 1))
+    counter = Counter("test_events", "A test counter")
+    hist.observe(0.5, kind="a")
+    counter.inc()
+    assert MetricsStore(tmp_path / "metrics.db").get_samples() == []
+
+    # two processes, e.g. gunicorn workers, record into the same database
+    for i in range(2):
+        mailadm.metrics.enable(tmp_path / "metrics.db")
+        hist.observe(0.05, kind="a")
+        hist.observe(2, kind='"b"')
+        counter.inc(2, result="ok")
+    samples = list(mailadm.metrics.render_samples())
+    assert samples == [
+        "# HELP test_seconds A test histogram",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{kind="a",le="0.1"} 2.0',
+        'test_seconds_bucket{kind="a",le="1.0"} 2.0',
+        'test_seconds_bucket{kind="a",le="+Inf"} 2.0',
+        'test_seconds_sum{kind="a"} 0.1',
+        'test_seconds_count{kind="a"} 2.0',
+        'test_seconds_bucket{kind="\\"b\\"",le="0.1"} 0.0',
+        'test_seconds_bucket{kind="\\"b\\"",le="1.0"} 0.0',
+        'test_seconds_bucket{kind="\\"b\\"",le="+Inf"} 2.0',
+        'test_seconds_sum{kind="\\"b\\""} 4.0',
+        'test_seconds_count{kind="\\"b\\""} 2.0',
+        "# HELP test_events A test counter",
+        "# TYPE test_events counter",
+        'test_events_total{result="ok"} 4.0',
+    ]
+
+
+def test_observations_kept_in_memory(tmp_path):
+    store = MetricsStore(tmp_path / "metrics.db")
+    store.add([("test_events", "test_events_total", "", 1)] * 3)
+    assert MetricsStore(tmp_path / "metrics.db").get_samples() == []
+    store.flush()
+    assert MetricsStore(tmp_path / "metrics.db").get_samples() == [
+        ("test_events", "test_events_total", "", 3)]
+
+    # a forked process doesn't write the observations of its parent again
+    store.add([("test_events", "test_events_total", "", 1)])
+    store._after_fork()
+    assert store.get_samples() == [("test_events", "test_events_total", "", 3)]
+
+
+def test_metrics_endpoint(db, monkeypatch):
+    with db.write_transaction() as conn:
+        conn.add_token(name="test123", token="12319831923123", prefix="pytest.", expiry="1w",
+                       maxuse=5)
+    app = create_app_from_db_path(db.path).test_client()
+    # token names and usage aren't public by default
+    assert app.get('/metrics').status_code == 404
+
+    monkeypatch.setenv("MAILADM_METRICS", "1")
+    app = create_app_from_db_path(db.path).test_client()
+    assert app.post('/?t=00000').status_code == 403
+    r = app.get('/metrics')
+    assert r.status_code == 200
+    assert r.content_type.startswith("text/plain")
+    lines = r.get_data(as_text=True).splitlines()
+    assert 'mailadm_signup_seconds_count{status="403"} 1.0' in lines
+    assert "# TYPE mailadm_mailcow_request_seconds histogram" in lines
+    assert 'mailadm_token_usecount{token="test123"} 0.0' in lines
+    assert 'mailadm_token_maxuse{token="test123"} 5.0' in lines
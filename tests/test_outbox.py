@@ -0,0 +1,152 @@
+import time
+
+import pytest
+from requests.exceptions import ReadTimeout
+
+from mailadm.commands import prune
+from mailadm.mailcow import MailcowConnection, MailcowUser
+from mailadm.outbox import process_outbox
+
+
+@pytest.fixture
+def mailcow_down(monkeypatch):
+    """Let mailcow fail until mailcow_down.clear() is called."""
+    class State:
+        down = True
+        deleted = []
+
+        def clear(self):
+            self.down = False
+
+    state = State()
+
+    def del_users_mailcow(self, addrs):
+        if state.down:
+            raise ReadTimeout("mailcow is down")
+        state.deleted.extend(addrs)
+        return {}
+
+    monkeypatch.setattr(MailcowConnection, "del_users_mailcow", del_users_mailcow)
+    monkeypatch.setenv("MAILADM_OUTBOX_MAX_ATTEMPTS", "3")
+    return state
+
+
+@pytest.fixture
+def token_info(db):
+    with db.write_transaction() as conn:
+        return conn.add_token("burner1", expiry="1h", token="1h_7wDioPeeXyZx96v3",
+                              prefix="tmp.")
+
+
+def test_delete_retried_with_backoff(db, token_info, mailcow_down):
+    addr = "tmp.1@x.testrun.org"
+    with db.write_transaction() as conn:
+        conn.add_user_db(addr, int(time.time()), 3600, "burner1")
+        conn.add_mailbox_mirror(addr, "burner1")
+        conn.delete_email_account(addr)
+
+    now = int(time.time())
+    assert list(process_outbox(db, addrs=[addr])) == [addr]
+    with db.read_connection() as conn:
+        [entry] = conn.get_outbox()
+    assert entry.action == "delete" and entry.attempts == 1 and not entry.dead
+    assert entry.next_attempt >= now + 30
+    # not due yet
+    assert process_outbox(db) == {}
+
+    for i in range(2):
+        process_outbox(db, addrs=[addr])
+    with db.read_connection() as conn:
+        [entry] = conn.get_outbox()
+        assert entry.dead and "mailcow is down" in entry.error
+        assert conn.get_next_outbox_attempt() is None
+    with db.write_transaction() as conn:
+        assert conn.revive_outbox() == 1
+
+    mailcow_down.clear()
+    assert process_outbox(db) == {}
+    assert mailcow_down.deleted == [addr]
+    with db.read_connection() as conn:
+        assert conn.get_outbox() == []
+        assert conn.execute("SELECT COUNT(*) FROM mailboxes").fetchone()[0] == 0
+
+
+def test_prune_with_mailcow_down(db, token_info, mailcow_down):
+    with db.write_transaction() as conn:
+        for i in range(3):
+            conn.add_user_db("tmp.%d@x.testrun.org" % (i,), 1000, 60, "burner1")
+    result = prune(db)
+    assert result["status"] == "error"
+    assert "will retry" in result["message"][0]
+    with db.read_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+        assert len(conn.get_outbox()) == 3
+
+    mailcow_down.clear()
+    with db.write_transaction() as conn:
+        conn.revive_outbox()
+    process_outbox(db)
+    assert len(mailcow_down.deleted) == 3
+
+
+@pytest.mark.parametrize("name", ["burner1", "alpha", "1d"])
+def test_signup_timeout_cleans_up(db, monkeypatch, name):
+    with db.write_transaction() as conn:
+        token_info = conn.add_token(name, expiry="1h", token="1h_7wDioPeeXyZx96v3",
+                                    prefix="tmp.")
+    created = {}
+
+    def add_user_mailcow(self, addr, password, token, quota=0, active=True):
+        created[addr] = token
+        raise ReadTimeout("mailcow is slow")
+
+    def get_user(self, addr):
+        if addr in created:
+            return MailcowUser({"username": addr, "tags": ["mailadm:" + created[addr]]})
+
+    def del_users_mailcow(self, addrs):
+        for addr in addrs:
+            del created[addr]
+        return {}
+
+    monkeypatch.setattr(MailcowConnection, "add_user_mailcow", add_user_mailcow)
+    monkeypatch.setattr(MailcowConnection, "get_user", get_user)
+    monkeypatch.setattr(MailcowConnection, "del_users_mailcow", del_users_mailcow)
+
+    with pytest.raises(ReadTimeout):
+        db.add_email_account_tries(token_info)
+    [addr] = list(created)
+    with db.read_connection() as conn:
+        assert conn.get_tokeninfo_by_name(name).usecount == 0
+        [entry] = conn.get_outbox()
+    assert entry.action == "create" and entry.addr == addr
+
+    # the mailbox which mailcow created despite the timeout is removed again
+    assert process_outbox(db) == {}
+    assert created == {}
+    with db.read_connection() as conn:
+        assert conn.get_outbox() == []
+
+
+def test_prune_leaves_reservations_to_outbox(db, token_info, mailcow_down, monkeypatch):
+    addr = "tmp.1@x.testrun.org"
+    with db.write_transaction() as conn:
+        conn.reserve_email_account(token_info, addr=addr)
+        conn.add_outbox("create", addr, "burner1")
+        conn.execute("UPDATE users SET date = date - 7200, expires_at = expires_at - 7200")
+    assert prune(db)["message"] == ["nothing to prune"]
+    with db.read_connection() as conn:
+        assert conn.get_tokeninfo_by_name("burner1").usecount == 1
+        [entry] = conn.get_outbox()
+        assert entry.action == "create" and entry.token_name == "burner1"
+
+    # the mailbox was created by someone else, so it is kept
+    mcuser = MailcowUser({"username": addr, "tags": ["mailadm:other"]})
+    monkeypatch.setattr(MailcowConnection, "get_user", lambda self, addr: mcuser)
+    mailcow_down.clear()
+    assert process_outbox(db) == {}
+    assert mailcow_down.deleted == []
+    with db.read_connection() as conn:
+        assert conn.get_tokeninfo_by_name("burner1").usecount == 0
+        assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+        assert conn.get_outbox() == []
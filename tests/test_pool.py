@@ -0,0 +1,85 @@
+import pytest
+
+from mailadm.mailcow import MailcowConnection
+from mailadm.pool import fill_pool
+
+
+@pytest.fixture
+def mailcow_calls(monkeypatch):
+    calls = []
+
+    def add_user_mailcow(self, addr, password, token, quota=0, active=True):
+        calls.append(("add", addr, active, password))
+
+    def activate_user_mailcow(self, addr, password):
+        calls.append(("activate", addr, password))
+
+    def del_users_mailcow(self, addrs):
+        calls.extend(("del", addr) for addr in addrs)
+        return {}
+
+    monkeypatch.setattr(MailcowConnection, "add_user_mailcow", add_user_mailcow)
+    monkeypatch.setattr(MailcowConnection, "activate_user_mailcow", activate_user_mailcow)
+    monkeypatch.setattr(MailcowConnection, "del_users_mailcow", del_users_mailcow)
+    monkeypatch.setattr(MailcowConnection, "get_user", lambda self, addr: None)
+    monkeypatch.setenv("MAILADM_POOL_MAX", "3")
+    monkeypatch.setenv("MAILADM_POOL_MIN", "2")
+    return calls
+
+
+def test_fill_and_claim(db, mailcow_calls):
+    with db.write_transaction() as conn:
+        token_info = conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3",
+                                    prefix="tmp.", maxuse=5)
+    assert fill_pool(db) == 2
+    assert fill_pool(db) == 0
+    with db.read_connection() as conn:
+        pool = conn.get_pool_addrs("burner1")
+        # unclaimed pool accounts don't count against maxuse
+        assert conn.get_tokeninfo_by_name("burner1").usecount == 0
+    assert sorted(call[1] for call in mailcow_calls) == sorted(pool)
+    assert all(call[2] is False for call in mailcow_calls)
+    with db.read_connection() as conn:
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(account_pool)")]
+        assert "password" not in columns
+
+    user_info = db.add_email_account_tries(token_info)
+    assert user_info.addr in pool
+    assert mailcow_calls[-1] == ("activate", user_info.addr, user_info.password)
+    # the throwaway password of the pool mailbox isn't handed out
+    assert ("add", user_info.addr, False, user_info.password) not in mailcow_calls
+    with db.read_connection() as conn:
+        assert conn.get_pool_addrs("burner1") == [a for a in pool if a != user_info.addr]
+        assert conn.get_tokeninfo_by_name("burner1").usecount == 1
+
+    # the recent signup raises the target, but never above what the token can still create
+    assert fill_pool(db) == 1
+
+
+def test_pool_of_deleted_token(db, mailcow_calls):
+    with db.write_transaction() as conn:
+        conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3", prefix="tmp.")
+    fill_pool(db)
+    with db.write_transaction() as conn:
+        pool = conn.get_pool_addrs("burner1")
+        conn.del_token("burner1")
+    fill_pool(db)
+    with db.read_connection() as conn:
+        assert conn.get_pool_addrs() == []
+    assert sorted(call[1] for call in mailcow_calls if call[0] == "del") == sorted(pool)
+
+
+def test_migrate_drops_pool_passwords(db):
+    with db.write_transaction() as conn:
+        conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3", prefix="tmp.")
+        conn.execute("DROP TABLE account_pool")
+        conn.execute("""CREATE TABLE account_pool (addr TEXT PRIMARY KEY,
+                        password TEXT NOT NULL, token_name TEXT NOT NULL,
+                        created INTEGER NOT NULL, ready INTEGER NOT NULL DEFAULT 0)""")
+        conn.execute("INSERT INTO account_pool VALUES ('tmp.1@x.org', 'secret', 'burner1', 1, 1)")
+        conn.set_config("dbversion", 10)
+    db.ensure_tables()
+    with db.write_transaction() as conn:
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(account_pool)")]
+        assert "password" not in columns
+        assert conn.claim_pool_account("burner1") == "tmp.1@x.org"
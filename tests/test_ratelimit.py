@@ -0,0 +1,30 @@
+from mailadm.ratelimit import RateLimiter
+
+
+def test_token_bucket(tmp_path):
+    limiter = RateLimiter(tmp_path / "ratelimit.db")
+    for i in range(3):
+        assert limiter.acquire([("a", 3)], now=1000) == 0
+    assert limiter.acquire([("a", 3)], now=1000) == 20
+    # one signup per 20 seconds is refilled
+    assert limiter.acquire([("a", 3)], now=1010) == 10
+    assert limiter.acquire([("a", 3)], now=1020) == 0
+    # other keys have their own buckets, and a rate of 0 means no limit
+    assert limiter.acquire([("b", 3), ("c", 0)], now=1020) == 0
+
+
+def test_all_or_nothing(tmp_path):
+    limiter = RateLimiter(tmp_path / "ratelimit.db")
+    assert limiter.acquire([("ip", 1)], now=1000) == 0
+    assert limiter.acquire([("ip", 1), ("token", 1)], now=1000) == 60
+    # a second limiter, e.g. of another worker, shares the buckets
+    other = RateLimiter(tmp_path / "ratelimit.db")
+    assert other.acquire([("token", 1)], now=1000) == 0
+    assert other.acquire([("token", 1)], now=1000) == 60
+
+
+def test_slow_rate(tmp_path):
+    limiter = RateLimiter(tmp_path / "ratelimit.db")
+    assert limiter.acquire([("a", 0.5)], now=1000) == 0
+    assert limiter.acquire([("a", 0.5)], now=1060) == 60
+    assert limiter.acquire([("a", 0.5)], now=1120) == 0
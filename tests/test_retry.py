@@ -0,0 +1,114 @@
+import collections
+import sqlite3
+
+import pytest
+from requests.exceptions import ConnectionError
+
+import mailadm.retry
+from mailadm.conn import DBError, TokenExhausted
+from mailadm.mailcow import MailcowConnection, MailcowError, MailcowUnavailable
+from mailadm.retry import COLLISION, PERMANENT, TRANSIENT, RetryPolicy, classify
+from mailadm.util import Deadline
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(mailadm.retry.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def failing(*errors):
+    """Return a function which raises the given errors, one per call, then returns 42."""
+    errors = list(errors)
+
+    def func():
+        if errors:
+            raise errors.pop(0)
+        return 42
+    return func
+
+
+@pytest.mark.parametrize("exc,kind", [
+    (MailcowError("account does already exist"), COLLISION),
+    (MailcowError({"type": "danger", "msg": ["object_exists", "tmp.x@x.org"]}), COLLISION),
+    (DBError("UNIQUE constraint failed: users.addr"), COLLISION),
+    (ConnectionError("connection refused"), TRANSIENT),
+    (DBError("timeout while waiting for the database write lock"), TRANSIENT),
+    (sqlite3.OperationalError("database is locked"), TRANSIENT),
+    (MailcowError("quota too high"), PERMANENT),
+    (MailcowUnavailable(10), PERMANENT),
+    (TokenExhausted("token exhausted"), PERMANENT),
+    (ValueError("invalid address"), PERMANENT),
+])
+def test_classify(exc, kind):
+    assert classify(exc) == kind
+
+
+def test_collision_retried_at_once(sleeps):
+    policy = RetryPolicy()
+    assert policy.run(failing(MailcowError("account does already exist")), tries=2) == 42
+    assert sleeps == []
+    assert policy.counters["collision_retried"] == 1
+    with pytest.raises(MailcowError):
+        policy.run(failing(MailcowError("account does already exist")), tries=2,
+                   collisions=False)
+
+
+def test_transient_backoff(sleeps):
+    policy = RetryPolicy(backoff=1, max_backoff=3)
+    errors = [ConnectionError("down")] * 4
+    assert policy.run(failing(*errors), tries=5) == 42
+    assert len(sleeps) == 4
+    for delay, limit in zip(sleeps, [1, 2, 3, 3]):
+        assert 0 <= delay <= limit
+    assert policy.counters["transient_retried"] == 4
+
+    with pytest.raises(ConnectionError):
+        policy.run(failing(*errors), tries=3)
+    assert policy.counters["transient_failed"] == 1
+
+
+def test_transient_respects_deadline(sleeps):
+    policy = RetryPolicy(backoff=10, max_backoff=10)
+    policy.get_delay = lambda retry: 5
+    with pytest.raises(ConnectionError):
+        policy.run(failing(ConnectionError("down")), tries=3, deadline=Deadline(1))
+    assert sleeps == []
+
+
+def test_permanent_fails_fast(sleeps):
+    policy = RetryPolicy()
+    with pytest.raises(TokenExhausted):
+        policy.run(failing(TokenExhausted("exhausted")), tries=10)
+    assert sleeps == []
+    assert policy.counters["permanent_failed"] == 1
+
+
+def test_budget(sleeps):
+    policy = RetryPolicy(budget=2, window=60)
+    assert policy.run(failing(ConnectionError("down"), ConnectionError("down")), tries=3) == 42
+    with pytest.raises(ConnectionError):
+        policy.run(failing(ConnectionError("down")), tries=3)
+    assert policy.counters["budget_exhausted"] == 1
+    policy._retries = collections.deque(t - 61 for t in policy._retries)
+    assert policy.run(failing(ConnectionError("down")), tries=3) == 42
+
+
+def test_add_email_account_collision(db, monkeypatch):
+    with db.write_transaction() as conn:
+        token_info = conn.add_token("burner1", expiry="1w", token="1w_7wDioPeeXyZx96v3",
+                                    prefix="tmp.", maxuse=1)
+    addrs = []
+
+    def add_user_mailcow(self, addr, password, token, quota=0):
+        addrs.append(addr)
+        if len(addrs) == 1:
+            raise MailcowError({"type": "danger", "msg": ["object_exists", addr]})
+
+    monkeypatch.setattr(MailcowConnection, "get_user", lambda self, addr: None)
+    monkeypatch.setattr(MailcowConnection, "add_user_mailcow", add_user_mailcow)
+    db.retry_policy = policy = RetryPolicy()
+    user_info = db.add_email_account_tries(token_info, tries=2)
+    assert user_info.addr == addrs[1] != addrs[0]
+    assert policy.counters["collision_retried"] == 1
@@ -0,0 +1,100 @@
+import time
+
+import pytest
+
+from mailadm.commands import prune
+from mailadm.mailcow import MailcowConnection
+from mailadm.scheduler import PruneScheduler, parse_windows
+
+
+@pytest.fixture
+def deleted(monkeypatch):
+    deleted = []
+
+    def del_users_mailcow(self, addrs):
+        deleted.extend(addrs)
+        return {}
+
+    monkeypatch.setattr(MailcowConnection, "del_users_mailcow", del_users_mailcow)
+    return deleted
+
+
+def test_sleeps_until_next_expiry(db, deleted):
+    now = int(time.time())
+    scheduler = PruneScheduler(db, min_interval=10, max_interval=3600, jitter=0, batch=2)
+    scheduler.run_once()
+    assert scheduler.wakeup_at == pytest.approx(now + 3600, abs=5)
+
+    with db.write_transaction() as conn:
+        conn.add_token("burner1", expiry="1h", token="1h_7wDioPeeXyZx96v3", prefix="tmp.")
+        for i in range(3):
+            conn.add_user_db("tmp.old%d@x.testrun.org" % (i,), now - 100, 10, "burner1")
+        conn.add_user_db("tmp.new@x.testrun.org", now, 120, "burner1")
+
+    # a batch of the oldest users is pruned, the rest is due after min_interval
+    scheduler.run_once()
+    assert deleted == ["tmp.old0@x.testrun.org", "tmp.old1@x.testrun.org"]
+    assert scheduler.wakeup_at == pytest.approx(scheduler.last_run + 10, abs=1)
+    scheduler.run_once()
+    assert deleted[2:] == ["tmp.old2@x.testrun.org"]
+    assert scheduler.wakeup_at == pytest.approx(now + 121, abs=5)
+
+    with db.write_transaction() as conn:
+        conn.del_users_db(["tmp.new@x.testrun.org"])
+    # new users of the 1h token can't expire before an hour has passed
+    scheduler.plan()
+    assert scheduler.wakeup_at == pytest.approx(now + 3600, abs=5)
+
+
+def test_parse_windows():
+    assert parse_windows("") == []
+    assert parse_windows("01:00-05:30, 22:00-02:00") == [(60, 330), (1320, 120)]
+    with pytest.raises(ValueError):
+        parse_windows("1-5")
+    with pytest.raises(ValueError):
+        parse_windows("01:00-24:00")
+    with pytest.raises(ValueError):
+        parse_windows("01:00-01:00")
+
+
+def test_maintenance_window(db, deleted):
+    # 2 a.m. local time today
+    night = time.mktime(time.localtime()[:3] + (2, 0, 0, 0, 0, -1))
+    scheduler = PruneScheduler(db, min_interval=10, jitter=0, batch=100, peak_batch=2,
+                               rate=0, windows=parse_windows("23:00-03:00,04:00-05:00"))
+    assert scheduler.get_window_delay(night) == 0
+    assert scheduler.get_window_delay(night + 5400 + 30) == 30 * 60 - 30
+    assert scheduler.get_window_delay(night + 7200) == 0
+    assert scheduler.get_window_delay(night + 3 * 3600) == 18 * 3600
+
+    now = int(time.time())
+    with db.write_transaction() as conn:
+        conn.add_token("burner1", expiry="1h", token="1h_7wDioPeeXyZx96v3", prefix="tmp.")
+        for i in range(5):
+            conn.add_user_db("tmp.old%d@x.testrun.org" % (i,), now - 100 + i, 10, "burner1")
+
+    # outside of the windows, only the oldest ones are deleted, the rest waits
+    scheduler.get_window_delay = lambda now: 600
+    scheduler.run_once()
+    assert deleted == ["tmp.old0@x.testrun.org", "tmp.old1@x.testrun.org"]
+    assert scheduler.wakeup_at == pytest.approx(scheduler.last_run + 600, abs=1)
+
+    scheduler.get_window_delay = lambda now: 0
+    scheduler.run_once()
+    assert len(deleted) == 5
+
+
+def test_prune_rate(db, deleted, monkeypatch):
+    now = int(time.time())
+    with db.write_transaction() as conn:
+        conn.add_token("burner1", expiry="1h", token="1h_7wDioPeeXyZx96v3", prefix="tmp.")
+        for i in range(5):
+            conn.add_user_db("tmp.old%d@x.testrun.org" % (i,), now - 100 + i, 10, "burner1")
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    result = prune(db, limit=4, rate=2)
+    assert len(result["message"]) == 4
+    assert deleted == ["tmp.old%d@x.testrun.org" % (i,) for i in range(4)]
+    # chunks of 2 users, one second apart
+    assert len(sleeps) == 2
+    assert sleeps[1] == pytest.approx(1, abs=0.1)
@@ -0,0 +1,56 @@
+import threading
+
+from mailadm.supervisor import Service, Supervisor, ON_FAILURE
+from mailadm.web import create_app_from_db
+
+
+def test_restart_with_backoff(db):
+    calls = []
+    done = threading.Event()
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ValueError("boom %d" % len(calls))
+        done.set()
+
+    def record_status(name, status):
+        db.write(lambda conn: conn.set_service_status(name, **status))
+
+    supervisor = Supervisor(on_status=record_status)
+    supervisor.add(Service("flaky", flaky, restart=ON_FAILURE, backoff=0.01))
+    supervisor.start()
+    assert done.wait(timeout=10)
+    supervisor.stop()
+    assert supervisor.get_status()["flaky"]["restarts"] == 2
+    assert supervisor.get_status()["flaky"]["error"] == "ValueError: boom 2"
+
+    with db.read_connection() as conn:
+        status = conn.get_service_statuses()["flaky"]
+    assert status["restarts"] == 2
+
+
+def test_give_up_after_max_restarts(db):
+    supervisor = Supervisor()
+    supervisor.add(Service("broken", lambda: 1 / 0, backoff=0, max_restarts=2))
+    supervisor.start()
+    supervisor._thread.join(timeout=0.5)
+    status = supervisor.get_status()["broken"]
+    assert status["state"] == "failed"
+    assert status["restarts"] == 2
+    assert "ZeroDivisionError" in status["error"]
+
+
+def test_health(db):
+    app = create_app_from_db(db).test_client()
+    r = app.get("/health")
+    assert r.status_code == 200
+    assert r.json["status"] == "ok"
+
+    with db.write_transaction() as conn:
+        conn.set_service_status("prune", "running")
+        conn.set_service_status("bot", "restarting", restarts=3, error="OSError: gone")
+    r = app.get("/health")
+    assert r.status_code == 503
+    assert r.json["failing"] == ["bot"]
+    assert r.json["services"]["bot"]["restarts"] == 3
@@ -0,0 +1,71 @@
+import json
+
+import mailadm.tracing
+from mailadm.web import create_app_from_db_path
+
+
+def test_not_sampled(monkeypatch):
+    assert mailadm.tracing.span("db.write") is mailadm.tracing._nospan
+    monkeypatch.setenv("MAILADM_TRACE_SAMPLE", "0")
+    with mailadm.tracing.trace("new_email") as trace:
+        assert trace is None
+        assert mailadm.tracing.span("db.write") is mailadm.tracing._nospan
+
+
+def test_nested_spans(monkeypatch, tmp_path):
+    monkeypatch.setenv("MAILADM_TRACE_SAMPLE", "1")
+    monkeypatch.setenv("MAILADM_TRACE_FILE", str(tmp_path / "trace.jsonl"))
+    try:
+        with mailadm.tracing.trace("request") as trace:
+            with mailadm.tracing.span("outer", attempt=1):
+                with mailadm.tracing.span("inner"):
+                    pass
+                raise ValueError("failed")
+    except ValueError:
+        pass
+    assert mailadm.tracing.span("outer") is mailadm.tracing._nospan
+    inner, outer, root = [json.loads(line) for line in open(tmp_path / "trace.jsonl")]
+    assert (inner["name"], outer["name"], root["name"]) == ("inner", "outer", "request")
+    assert inner["parent"] == outer["span"] and outer["parent"] == root["span"]
+    assert root["parent"] is None
+    assert inner["trace"] == outer["trace"] == root["trace"] == trace.id
+    assert outer["attempt"] == 1 and outer["error"] == "ValueError: failed"
+    assert root["duration"] >= outer["duration"] >= inner["duration"] >= 0
+    assert trace.get_server_timing().startswith("inner;dur=")
+    assert 'outer;dur=' in trace.get_server_timing()
+    assert ';desc="attempt=1"' in trace.get_server_timing()
+
+
+def test_signup_trace(db, monkeypatch, tmp_path):
+    with db.write_transaction() as conn:
+        conn.add_token(name="test123", token="12319831923123", prefix="pytest.", expiry="1w")
+        session = conn.get_mailcow_connection().session
+
+    class Response:
+        status_code = 200
+
+        def __init__(self, result):
+            self.result = result
+
+        def json(self):
+            return self.result
+
+    monkeypatch.setattr(session, "get", lambda url, **kwargs: Response({}))
+    monkeypatch.setattr(session, "post",
+                        lambda url, **kwargs: Response([{"type": "success"}]))
+    monkeypatch.setenv("MAILADM_TRACE_SAMPLE", "1")
+    monkeypatch.setenv("MAILADM_TRACE_FILE", str(tmp_path / "trace.jsonl"))
+
+    app = create_app_from_db_path(db.path).test_client()
+    r = app.post('/?t=12319831923123')
+    assert r.status_code == 200
+    assert 'mailcow;dur=' in r.headers["Server-Timing"]
+    spans = [json.loads(line) for line in open(tmp_path / "trace.jsonl")]
+    names = [span["name"] for span in spans]
+    assert names[-1] == "new_email"
+    assert "ratelimit" in names and "db.write" in names
+    signup = spans[names.index("add_email_account")]
+    assert signup["attempt"] == 1
+    mailcow = [span for span in spans if span["name"] == "mailcow"]
+    assert {"add/mailbox"} <= {span["endpoint"] for span in mailcow}
+    assert all(span["parent"] == signup["span"] for span in mailcow)
@@ -1,8 +1,10 @@
 
 import sys
+import time
 import pytest
 
-from mailadm.util import parse_expiry_code, get_human_readable_id
+from mailadm.util import parse_expiry_code, get_human_readable_id, PrefixTrie, Deadline, \
+    DeadlineExceeded
 
 
 @pytest.mark.parametrize("code,duration", [
@@ -32,3 +34,26 @@ def test_parse_expiries_wrong():
 def test_human_readable_id():
     s = get_human_readable_id(len=20)
     assert s.isalnum()
+
+
+def test_prefix_trie():
+    trie = PrefixTrie()
+    assert trie.longest_prefix_value("tmp.abc@x.org") is None
+    trie.add("tmp.", "tmp")
+    trie.add("tmp.event.", "event")
+    trie.add("", "default")
+    assert trie.longest_prefix_value("tmp.abc@x.org") == "tmp"
+    assert trie.longest_prefix_value("tmp.event.abc@x.org") == "event"
+    assert trie.longest_prefix_value("tmp.even@x.org") == "tmp"
+    assert trie.longest_prefix_value("other@x.org") == "default"
+
+
+def test_deadline(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    deadline = Deadline(10)
+    assert deadline.get_timeout() == 10
+    assert deadline.get_timeout(maximum=3) == 3
+    now[0] += 10
+    with pytest.raises(DeadlineExceeded):
+        deadline.get_timeout(what="testing")
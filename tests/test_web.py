@@ -1,6 +1,7 @@
 import time
 from mailadm.web import create_app_from_db_path
 import mailadm
+from mailadm.conn import TokenExhausted
 import random
 
 
@@ -82,3 +83,87 @@ def xxxtest_new_user_usermod(db):
     assert r.json["email"] == "hello2@x.testrun.org"
     assert r.json["password"] == "l123123123123"
     assert int(r.json["expires"]) > (now + 4 * 24 * 60 * 60)
+
+
+def test_mailcow_unavailable(db):
+    with db.write_transaction() as conn:
+        conn.add_token(name="test123", token="12319831923123", prefix="pytest.", expiry="1w")
+        endpoint = conn.config.mailcow_endpoint
+    breaker = mailadm.mailcow.get_circuit_breaker(endpoint)
+    breaker.state, breaker.opened_at = "open", time.monotonic()
+
+    app = create_app_from_db_path(db.path).test_client()
+    r = app.post('/?t=12319831923123')
+    assert r.status_code == 503
+    assert int(r.headers["Retry-After"]) == breaker.cooldown
+    with db.read_connection() as conn:
+        assert conn.get_tokeninfo_by_name("test123").usecount == 0
+    assert app.get("/health").json["mailcow"] == "open"
+
+
+def test_token_cache(db, monkeypatch):
+    with db.write_transaction() as conn:
+        conn.add_token(name="test123", token="12319831923123", prefix="pytest.", expiry="1w",
+                       maxuse=1)
+        conn.add_user_db("pytest.a@x.testrun.org", 1000, 60, "test123")
+    lookups = []
+    get_tokeninfo_by_token = mailadm.conn.Connection.get_tokeninfo_by_token
+
+    def lookup(conn, token):
+        lookups.append(token)
+        return get_tokeninfo_by_token(conn, token)
+    monkeypatch.setattr(mailadm.conn.Connection, "get_tokeninfo_by_token", lookup)
+
+    signups = []
+
+    def add_email_account_tries(db, token_info, **kwargs):
+        signups.append(token_info.name)
+        raise TokenExhausted
+    monkeypatch.setattr(mailadm.db.DB, "add_email_account_tries", add_email_account_tries)
+
+    app = create_app_from_db_path(db.path).test_client()
+    for i in range(3):
+        r = app.post('/?t=00000')
+        assert r.status_code == 403
+        r = app.post('/?t=12319831923123')
+        assert r.status_code == 410
+        assert r.json.get("reason") == "token 12319831923123 is exhausted"
+    assert lookups == ["00000", "12319831923123"]
+    assert signups == []
+
+    # a new token invalidates the cache; the exhaustion found by the signup is cached
+    with db.write_transaction() as conn:
+        conn.add_token(name="test456", token="00000", prefix="pytest.", expiry="1w")
+    for i in range(2):
+        r = app.post('/?t=00000')
+        assert r.status_code == 410
+    assert signups == ["test456"]
+    assert lookups == ["00000", "12319831923123", "00000"]
+
+
+def test_rate_limit(db, monkeypatch):
+    with db.write_transaction() as conn:
+        conn.add_token(name="test123", token="12319831923123", prefix="pytest.", expiry="1w")
+        conn.add_token(name="test456", token="45619831923123", prefix="pytest.", expiry="1w")
+        conn.mod_token("test123", rate=1)
+    signups = []
+
+    def add_email_account_tries(db, token_info, **kwargs):
+        signups.append(token_info.name)
+        raise TokenExhausted
+    monkeypatch.setattr(mailadm.db.DB, "add_email_account_tries", add_email_account_tries)
+    monkeypatch.setenv("MAILADM_IP_RATE", "1")
+
+    app = create_app_from_db_path(db.path).test_client()
+    other_ip = {"REMOTE_ADDR": "10.0.0.2"}
+    app.post('/?t=12319831923123')
+    assert signups == ["test123"]
+    r = app.post('/?t=12319831923123', environ_base=other_ip)
+    assert r.status_code == 429
+    assert 0 < int(r.headers["Retry-After"]) <= 60
+    # the token limit doesn't affect other tokens, but the IP limit does
+    app.post('/?t=45619831923123', environ_base=other_ip)
+    assert signups == ["test123", "test456"]
+    r = app.post('/?t=45619831923123')
+    assert r.status_code == 429
+    assert signups == ["test123", "test456"]